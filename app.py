@@ -6,15 +6,31 @@ warnings.filterwarnings("ignore")
 # Import required libraries
 import streamlit as st
 import pandas as pd
+import numpy as np
 import json
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 import plotly.express as px
-from PIL import Image
+from PIL import Image, ImageOps
 import io
 import base64
 import hashlib
 import uuid
+import sqlite3
+import threading
+import queue
+import time
+import functools
+import itertools
+from collections import OrderedDict
+import openpyxl
+import glob
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # Set page configuration
 st.set_page_config(
@@ -23,43 +39,12 @@ st.set_page_config(
     layout="wide"
 )
 
-# Initialize session state for storing data
-if 'rfid_data' not in st.session_state:
-    st.session_state.rfid_data = {}
-if 'products' not in st.session_state:
-    st.session_state.products = {}
-if 'categories' not in st.session_state:
-    st.session_state.categories = []
-if 'transactions' not in st.session_state:
-    st.session_state.transactions = []
-if 'sales' not in st.session_state:
-    st.session_state.sales = []
-if 'branches' not in st.session_state:
-    # Default main branch
-    st.session_state.branches = {
-        "main": {"name": "Main Branch", "address": "Main Location", "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-    }
+# Initialize session state
 if 'current_branch' not in st.session_state:
     st.session_state.current_branch = "main"
-if 'transfers' not in st.session_state:
-    st.session_state.transfers = []
 if 'active_tab' not in st.session_state:
     st.session_state.active_tab = "Upload"
 
-# User management initialization
-if 'users' not in st.session_state:
-    # Default admin user (password: admin123)
-    st.session_state.users = {
-        "admin": {
-            "password": hashlib.sha256("admin123".encode()).hexdigest(),
-            "role": "admin",
-            "permissions": ["view", "add", "edit", "delete", "manage_users"],
-            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "active": True,
-            "name": "Administrator"
-        }
-    }
-
 # Authentication state
 if 'authenticated' not in st.session_state:
     st.session_state.authenticated = False
@@ -72,6 +57,25 @@ if 'user_permissions' not in st.session_state:
 if 'user_name' not in st.session_state:
     st.session_state.user_name = None
 
+# Processed upload files of this session
+if 'upload_cache' not in st.session_state:
+    st.session_state.upload_cache = OrderedDict()
+# Classification of the uploaded RFID tags and the inventory version it was made for
+if 'upload_classification' not in st.session_state:
+    st.session_state.upload_classification = None
+
+# Product catalogue page and the search/filter it belongs to
+if 'product_page' not in st.session_state:
+    st.session_state.product_page = 1
+if 'product_filter' not in st.session_state:
+    st.session_state.product_filter = None
+
+# Scanned items waiting to be sold, by RFID, and the outcome of the last scan or sale
+if 'sale_basket' not in st.session_state:
+    st.session_state.sale_basket = {}
+if 'sale_basket_message' not in st.session_state:
+    st.session_state.sale_basket_message = None
+
 # Create data directory if it doesn't exist
 os.makedirs('data', exist_ok=True)
 os.makedirs('data/images', exist_ok=True)
@@ -85,71 +89,1303 @@ SALES_PATH = 'data/sales.json'
 BRANCHES_PATH = 'data/branches.json'
 TRANSFERS_PATH = 'data/transfers.json'
 USERS_PATH = 'data/users.json'
-# Load data from files if they exist
-def load_data():
-    try:
-        if os.path.exists(RFID_DATA_PATH):
-            with open(RFID_DATA_PATH, 'r', encoding='utf-8') as f:
-                st.session_state.rfid_data = json.load(f)
+JOURNAL_PATH = 'data/journal.jsonl'
+SQLITE_PATH = 'data/inventory.db'
+IMAGES_DIR = 'data/images'
+ARCHIVE_DIR = 'data/archive'
+ARCHIVE_MANIFEST_PATH = 'data/archive/manifest.json'
+
+# Storage engine: "json" (snapshot files plus journal) or "sqlite"
+STORAGE_BACKEND = os.environ.get('RFID_STORAGE_BACKEND', 'json')
+
+# Snapshot file for every persisted collection in st.session_state
+DATA_COLLECTIONS = {
+    'rfid_data': RFID_DATA_PATH,
+    'products': PRODUCTS_PATH,
+    'categories': CATEGORIES_PATH,
+    'transactions': TRANSACTIONS_PATH,
+    'sales': SALES_PATH,
+    'branches': BRANCHES_PATH,
+    'transfers': TRANSFERS_PATH,
+    'users': USERS_PATH
+}
+
+# Timestamp field of the history collections
+TIME_COLUMNS = {
+    'transactions': 'timestamp',
+    'sales': 'sale_date',
+    'transfers': 'timestamp'
+}
+
+# Timestamp fields of every collection. Timestamps are stored as int64 seconds
+# since 1970-01-01 of the server's local wall-clock time, i.e. the local date
+# and time read as if they were UTC, so they turn into naive datetime64[s]
+# values without any parsing or time zone handling. Integers received from
+# outside are Unix times and are converted to local time first (see
+# unix_to_epoch). Data saved with TIMESTAMP_FORMAT strings is converted when it
+# is loaded.
+TIMESTAMP_FIELDS = {
+    'rfid_data': ['added_at'],
+    'transactions': ['timestamp'],
+    'sales': ['sale_date'],
+    'transfers': ['timestamp'],
+    'branches': ['created_at'],
+    'users': ['created_at', 'modified_at']
+}
+
+# Format of timestamps in uploaded files, reader events and older data
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+SECONDS_PER_DAY = 86400
+
+# Fields stored for the records of the history collections
+HISTORY_COLUMNS = {
+    'transactions': ['rfid', 'product_id', 'branch_id', 'from_branch_id', 'to_branch_id', 'action', 'timestamp'],
+    'sales': ['rfid', 'product_id', 'product_name', 'category', 'branch_id', 'sale_date', 'sale_price'],
+    'transfers': ['rfid', 'product_id', 'product_name', 'from_branch_id', 'to_branch_id', 'timestamp']
+}
+
+# History records older than this many days are moved to the Parquet archive (0 disables it)
+ARCHIVE_AFTER_DAYS = int(os.environ.get('RFID_ARCHIVE_AFTER_DAYS', '365'))
+
+# Number of journal records after which the journal is folded into the snapshots
+JOURNAL_COMPACT_THRESHOLD = 10000
+
+# Uploaded files are read and processed this many rows at a time
+UPLOAD_CHUNK_ROWS = 10000
+UPLOAD_FILE_TYPES = ["xlsx", "xls", "csv", "parquet"]
+# Number of processed upload files kept per session
+UPLOAD_CACHE_SIZE = 4
+# Most products listed at once as matches of a product search
+PRODUCT_OPTION_LIMIT = 200
+# Product cards shown per catalogue page
+PRODUCTS_PER_PAGE = 12
+# Records shown per page of a raw history table
+HISTORY_ROWS_PER_PAGE = 500
+# Longest side in pixels of the saved product images and of their scaled-down variants
+IMAGE_MAX_SIZE = 2048
+IMAGE_VARIANTS = {'thumbnail': 200, 'preview': 800}
+# Threads that process uploaded product images in the background
+IMAGE_WORKERS = 2
+# Number of finished image jobs kept for the status list
+IMAGE_JOB_HISTORY = 50
+# Number of encoded image variants kept in memory
+IMAGE_CACHE_SIZE = 512
+
+# Local endpoint for RFID reader events (see IngestService); port 0 disables it
+INGEST_HOST = os.environ.get('RFID_INGEST_HOST', '127.0.0.1')
+INGEST_PORT = int(os.environ.get('RFID_INGEST_PORT', '0'))
+# Reader events waiting to be written; further events are refused while it is full
+INGEST_QUEUE_SIZE = 10000
+# Queued events are committed together once this many have been collected or
+# this many milliseconds have passed since the first one
+INGEST_BATCH_SIZE = 500
+INGEST_BATCH_MS = 200
+# Repeated reads of a tag by the same reader within this many milliseconds of
+# its previous read are dropped (0 disables it); at most INGEST_DEDUP_CAPACITY
+# recent reads are remembered
+INGEST_DEDUP_MS = int(os.environ.get('RFID_INGEST_DEDUP_MS', '2000'))
+INGEST_DEDUP_CAPACITY = 100000
+
+# Daily rollups of history collections: the record fields that key a rollup row
+# within its day, and the field summed as revenue. Products are counted inside
+# the rows rather than as a dimension, so the rollups grow with the number of
+# days, not with the number of products sold or moved each day.
+ROLLUPS = {
+    'sales': {'dimensions': ['branch_id', 'category'], 'revenue': 'sale_price'},
+    'transactions': {'dimensions': ['action', 'branch_id']},
+    'transfers': {'dimensions': ['from_branch_id', 'to_branch_id']}
+}
+
+# Secondary indexes kept for each collection: field -> {value: set of keys}
+INDEXED_FIELDS = {
+    'rfid_data': ['branch_id', 'product_id'],
+    'products': ['category']
+}
+
+# Epoch seconds of a datetime, date or TIMESTAMP_FORMAT string
+def to_epoch(value):
+    if isinstance(value, str):
+        value = datetime.strptime(value, TIMESTAMP_FORMAT)
+    return int(np.datetime64(value, 's').astype(np.int64))
+
+def now_epoch():
+    return to_epoch(datetime.now())
+
+# Stored epoch seconds of a Unix time
+def unix_to_epoch(value):
+    return to_epoch(datetime.fromtimestamp(value))
+
+# Whether a value is a Unix time rather than a timestamp to parse
+def is_unix_time(value):
+    return isinstance(value, (int, float, np.number)) and not isinstance(value, bool) and value == value
+
+def format_epoch(value):
+    return str(np.datetime64(int(value), 's')).replace('T', ' ')
+
+# Epoch seconds of a sequence of timestamps (TIMESTAMP_FORMAT strings,
+# datetimes or Unix times), parsed in one vectorized pass; values that cannot
+# be parsed become default
+def parse_epochs(values, default=None):
+    values = pd.Series(values, dtype=object)
+    numeric = values.map(is_unix_time).to_numpy(dtype=bool)
+    parsed = pd.to_datetime(values.where(~numeric), format=TIMESTAMP_FORMAT, errors='coerce')
+    epochs = parsed.to_numpy(dtype='datetime64[s]').astype(np.int64).astype(object)
+    epochs[numeric] = values[numeric].map(unix_to_epoch).to_numpy()
+    epochs[~numeric & parsed.isna().to_numpy()] = default
+    return epochs
+
+# Convert timestamps saved as strings to epoch seconds in place; returns the
+# names of the changed collections
+def migrate_timestamps(data):
+    changed = set()
+    for collection, fields in TIMESTAMP_FIELDS.items():
+        if collection not in data:
+            continue
+        records = data[collection].values() if isinstance(data[collection], dict) else data[collection]
+        for field in fields:
+            outdated = [record for record in records if isinstance(record.get(field), str)]
+            if not outdated:
+                continue
+            for record, epoch in zip(outdated, parse_epochs([record[field] for record in outdated])):
+                record[field] = epoch
+            changed.add(collection)
+    return changed
+
+# Contents of the collections before anything is loaded from disk
+def default_collections():
+    created_at = now_epoch()
+    return {
+        'rfid_data': {},
+        'products': {},
+        'categories': [],
+        'transactions': [],
+        'sales': [],
+        # Default main branch
+        'branches': {
+            "main": {"name": "Main Branch", "address": "Main Location", "created_at": created_at}
+        },
+        'transfers': [],
+        # Default admin user (password: admin123)
+        'users': {
+            "admin": {
+                "password": hashlib.sha256("admin123".encode()).hexdigest(),
+                "role": "admin",
+                "permissions": ["view", "add", "edit", "delete", "manage_users"],
+                "created_at": created_at,
+                "active": True,
+                "name": "Administrator"
+            }
+        }
+    }
+
+# Process-wide data shared by all browser sessions. Sessions read the
+# collections through st.session_state aliases; every change goes through
+# data_batch(), which holds the write lock until the change is saved.
+class DataStore:
+    def __init__(self, storage):
+        self.storage = storage
+        self.lock = threading.RLock()
+        self.data = default_collections()
+        # Mutations recorded since the last flush_journal() call
+        self.pending_journal = []
+        # Number of records written since the last compaction
+        self.journal_length = 0
+        # Version counter per collection, bumped on every change
+        self.versions = {collection: 0 for collection in DATA_COLLECTIONS}
+        # Collections changed since their snapshot file was last written
+        self.dirty_collections = set()
+        # Nesting depth of data_batch() blocks and the undo records of the open batch
+        self.batch_depth = 0
+        self.undo_log = []
+        # Storage version the in-memory data was loaded from or last saved as
+        self.disk_version = None
+        # Secondary indexes, see INDEXED_FIELDS
+        self.indexes = {}
+        # Columnar copy of rfid_data, see InventoryView
+        self.inventory = InventoryView()
+        # Substring index over product IDs and names, see NgramIndex
+        self.product_search = NgramIndex()
+        # Daily rollups, see ROLLUPS
+        self.rollups = {collection: {} for collection in ROLLUPS}
+        # Committed archive runs, the rollups of their records and the day
+        # the history was last checked for records to archive
+        self.archive_runs = []
+        self.archive_rollups = (None, {})
+        self.archive_checked = None
+        # Background processing of uploaded product images, see queue_product_image
+        self.image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix='product-image')
+        self.image_jobs = OrderedDict()
+    
+    # Collections are also reachable as attributes, e.g. store.rfid_data
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['data'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+# Columnar copy of rfid_data shared by the inventory, sales and report pages.
+# Product, category and branch are kept as integer codes into append-only value
+# lists, so frames of the inventory are built with array operations instead of
+# a Python loop over every tag. A deleted row is replaced by the last row.
+# For RFID prefix searches the lowercased RFIDs are also kept sorted together
+# with their row. Added tags wait in a pending set that searches scan, and
+# removed tags leave a -1 row; both are merged into the sorted arrays once
+# they make up a noticeable share of the inventory. Writers change the view
+# under store.lock, so frame() and select() take it as well.
+class InventoryView:
+    FIELDS = ['product_id', 'category', 'branch_id']
+    NO_TIME = np.iinfo(np.int64).min
+    
+    def __init__(self, rfid_data=None):
+        rfid_data = rfid_data or {}
+        self.size = len(rfid_data)
+        self.positions = {rfid: position for position, rfid in enumerate(rfid_data)}
+        self.rfids = np.array(list(rfid_data), dtype=object)
+        self.added_at = np.array([self.added_time(value) for value in rfid_data.values()], dtype=np.int64)
+        self.codes = {}
+        self.values = {}
+        self.value_codes = {}
+        for field in self.FIELDS:
+            codes, values = pd.factorize(pd.Series([value.get(field) for value in rfid_data.values()], dtype=object))
+            self.codes[field] = codes.astype(np.int32)
+            self.values[field] = list(values)
+            self.value_codes[field] = {value: code for code, value in enumerate(values)}
         
-        if os.path.exists(PRODUCTS_PATH):
-            with open(PRODUCTS_PATH, 'r', encoding='utf-8') as f:
-                st.session_state.products = json.load(f)
+        keys = np.array([rfid.lower() for rfid in rfid_data], dtype=object)
+        order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[order]
+        self.sorted_rows = order.astype(np.int64)
+        self.pending_rfids = set()
+        self.removed_count = 0
+    
+    # Epoch seconds a tag was added, NO_TIME (NaT as datetime64) if unknown
+    def added_time(self, value):
+        added_at = value.get('added_at')
+        return self.NO_TIME if added_at is None else added_at
+    
+    # Code of a field value, -1 for missing values
+    def code(self, field, value):
+        if value is None:
+            return -1
+        codes = self.value_codes[field]
+        if value not in codes:
+            codes[value] = len(self.values[field])
+            self.values[field].append(value)
+        return codes[value]
+    
+    # Apply a change of one rfid_data record; value None removes the tag
+    def update(self, rfid, value):
+        if value is None:
+            self.remove(rfid)
+            return
         
-        if os.path.exists(CATEGORIES_PATH):
-            with open(CATEGORIES_PATH, 'r', encoding='utf-8') as f:
-                st.session_state.categories = json.load(f)
+        position = self.positions.get(rfid)
+        if position is None:
+            position = self.size
+            if position == len(self.rfids):
+                self.grow()
+            self.rfids[position] = rfid
+            self.positions[rfid] = position
+            self.pending_rfids.add(rfid)
+        self.added_at[position] = self.added_time(value)
+        for field in self.FIELDS:
+            self.codes[field][position] = self.code(field, value.get(field))
+        self.size = max(self.size, position + 1)
+    
+    def remove(self, rfid):
+        position = self.positions.pop(rfid, None)
+        if position is None:
+            return
+        self.move_sorted_row(rfid, position, -1)
+        last = self.size - 1
+        if position != last:
+            self.rfids[position] = self.rfids[last]
+            self.added_at[position] = self.added_at[last]
+            for field in self.FIELDS:
+                self.codes[field][position] = self.codes[field][last]
+            self.positions[self.rfids[position]] = position
+            self.move_sorted_row(self.rfids[position], last, position)
+        self.rfids[last] = None
+        self.added_at[last] = self.NO_TIME
+        self.size = last
+    
+    # Point the sorted entry of a tag at a new row (-1 marks it removed)
+    def move_sorted_row(self, rfid, row, new_row):
+        if rfid in self.pending_rfids:
+            if new_row == -1:
+                self.pending_rfids.discard(rfid)
+            return
+        # RFIDs differing only in case share a key, so find the entry by its row
+        index = np.searchsorted(self.sorted_keys, rfid.lower())
+        while self.sorted_rows[index] != row:
+            index += 1
+        self.sorted_rows[index] = new_row
+        if new_row == -1:
+            self.removed_count += 1
+    
+    # Merge the pending tags into the sorted arrays and drop removed entries
+    # once there are enough of them to be worth the copy
+    def merge_sorted(self):
+        threshold = max(1024, self.size // 64)
+        if self.removed_count > threshold:
+            kept = self.sorted_rows >= 0
+            self.sorted_keys = self.sorted_keys[kept]
+            self.sorted_rows = self.sorted_rows[kept]
+            self.removed_count = 0
+        if len(self.pending_rfids) > threshold:
+            pending = sorted(self.pending_rfids, key=str.lower)
+            keys = np.array([rfid.lower() for rfid in pending], dtype=object)
+            rows = np.array([self.positions[rfid] for rfid in pending], dtype=np.int64)
+            index = np.searchsorted(self.sorted_keys, keys)
+            self.sorted_keys = np.insert(self.sorted_keys, index, keys)
+            self.sorted_rows = np.insert(self.sorted_rows, index, rows)
+            self.pending_rfids = set()
+    
+    # Rows of the tags whose RFID starts with the (lowercase) prefix
+    def prefix_rows(self, prefix):
+        self.merge_sorted()
+        start = np.searchsorted(self.sorted_keys, prefix, side='left')
+        end = np.searchsorted(self.sorted_keys, prefix + '\U0010ffff', side='left')
+        rows = self.sorted_rows[start:end]
+        pending_rows = [self.positions[rfid] for rfid in self.pending_rfids if rfid.lower().startswith(prefix)]
+        return np.concatenate([rows[rows >= 0], np.array(pending_rows, dtype=np.int64)])
+    
+    # Mask over the first size rows of the rows whose RFID starts with the
+    # search text or whose product ID or name contains it
+    def search_mask(self, search, size):
+        search = search.strip().lower()
+        mask = np.zeros(size, dtype=bool)
+        mask[self.prefix_rows(search)] = True
+        product_codes = [self.value_codes['product_id'][product_id]
+                         for product_id in store.product_search.search(search)
+                         if product_id in self.value_codes['product_id']]
+        if product_codes:
+            mask |= np.isin(self.codes['product_id'][:size], product_codes)
+        return mask
+    
+    # RFIDs of the tags in a branch, optionally only of the given products and
+    # categories, oldest first
+    def select(self, branch_id, product_ids=None, categories=None):
+        with store.lock:
+            size = self.size
+            mask = self.codes['branch_id'][:size] == self.value_codes['branch_id'].get(branch_id, -2)
+            for field, values in (('product_id', product_ids), ('category', categories)):
+                if values:
+                    codes = [self.value_codes[field][value] for value in values if value in self.value_codes[field]]
+                    mask &= np.isin(self.codes[field][:size], codes)
+            rows = np.flatnonzero(mask)
+            rows = rows[np.argsort(self.added_at[rows], kind='stable')]
+            return self.rfids[rows]
+    
+    # Double the capacity of the columns
+    def grow(self):
+        capacity = max(2 * len(self.rfids), 1024)
+        extra = capacity - len(self.rfids)
+        self.rfids = np.concatenate([self.rfids, np.empty(extra, dtype=object)])
+        self.added_at = np.concatenate([self.added_at, np.full(extra, self.NO_TIME, dtype=np.int64)])
+        for field in self.FIELDS:
+            self.codes[field] = np.concatenate([self.codes[field], np.full(extra, -1, dtype=np.int32)])
+    
+    # Inventory of one branch (or all branches) as a DataFrame with categorical
+    # product, category and branch columns, optionally limited to the tags
+    # matching a search text (see search_mask). Sessions call this while
+    # writers change the view, so the columns are copied under the store lock.
+    def frame(self, branch_id=None, search=None):
+        with store.lock:
+            size = self.size
+            mask = None
+            if branch_id is not None:
+                branch_code = self.value_codes['branch_id'].get(branch_id, -2)
+                mask = self.codes['branch_id'][:size] == branch_code
+            if search:
+                search_mask = self.search_mask(search, size)
+                mask = search_mask if mask is None else mask & search_mask
+            rows = np.arange(size) if mask is None else np.flatnonzero(mask)
+            
+            rfids = self.rfids[rows]
+            added_at = self.added_at[rows]
+            codes = {field: self.codes[field][rows] for field in self.FIELDS}
+            values = {field: list(self.values[field]) for field in self.FIELDS}
+            # Names are looked up once per product and branch; the trailing
+            # "Unknown" is picked by the -1 code of missing values
+            product_names = np.array([product_name_of(product_id) for product_id in values['product_id']] + ["Unknown"],
+                                     dtype=object)
+            branch_names = np.array([store.branches[branch]['name'] if branch in store.branches else "Unknown"
+                                     for branch in values['branch_id']] + ["Unknown"], dtype=object)
         
-        if os.path.exists(TRANSACTIONS_PATH):
-            with open(TRANSACTIONS_PATH, 'r', encoding='utf-8') as f:
-                st.session_state.transactions = json.load(f)
+        def categorical(field):
+            return pd.Categorical.from_codes(codes[field], categories=values[field]).remove_unused_categories()
         
-        if os.path.exists(SALES_PATH):
-            with open(SALES_PATH, 'r', encoding='utf-8') as f:
-                st.session_state.sales = json.load(f)
-                
-        if os.path.exists(BRANCHES_PATH):
-            with open(BRANCHES_PATH, 'r', encoding='utf-8') as f:
-                st.session_state.branches = json.load(f)
-                
-        if os.path.exists(TRANSFERS_PATH):
-            with open(TRANSFERS_PATH, 'r', encoding='utf-8') as f:
-                st.session_state.transfers = json.load(f)
-                
-        if os.path.exists(USERS_PATH):
-            with open(USERS_PATH, 'r', encoding='utf-8') as f:
-                st.session_state.users = json.load(f)
-    except Exception as e:
-        st.error(f"Error loading data: {str(e)}")
+        return pd.DataFrame({
+            'RFID': rfids,
+            'Product ID': categorical('product_id'),
+            'Product Name': product_names[codes['product_id']],
+            'Category': categorical('category'),
+            'Branch ID': categorical('branch_id'),
+            'Branch Name': branch_names[codes['branch_id']],
+            'Added At': added_at.view('datetime64[s]')
+        })
 
-# Save data to files
-def save_data():
-    try:
-        with open(RFID_DATA_PATH, 'w', encoding='utf-8') as f:
-            json.dump(st.session_state.rfid_data, f, ensure_ascii=False, indent=2)
+# Substring index over one short text per key, e.g. the ID and name of every
+# product. Each text is lowercased and split into trigrams; a search
+# intersects the keys of the trigrams of the query and checks the remaining
+# candidates. Queries shorter than a trigram scan the texts.
+class NgramIndex:
+    N = 3
+    
+    def __init__(self):
+        self.texts = {}
+        self.postings = {}
+        # Keys in the order they were first added, so results keep that order
+        self.order = {}
+        self.next_order = 0
+    
+    def grams(self, text):
+        return {text[i:i + self.N] for i in range(len(text) - self.N + 1)}
+    
+    # Set the text of a key; text None removes the key
+    def update(self, key, text):
+        old_text = self.texts.get(key)
+        if old_text is not None:
+            for gram in self.grams(old_text):
+                keys = self.postings[gram]
+                keys.discard(key)
+                if not keys:
+                    del self.postings[gram]
+        if text is None:
+            self.texts.pop(key, None)
+            self.order.pop(key, None)
+            return
+        
+        text = text.lower()
+        self.texts[key] = text
+        for gram in self.grams(text):
+            self.postings.setdefault(gram, set()).add(key)
+        if key not in self.order:
+            self.order[key] = self.next_order
+            self.next_order += 1
+    
+    # Keys whose text contains the query, in the order they were added
+    def search(self, query):
+        query = query.strip().lower()
+        if len(query) < self.N:
+            return [key for key, text in self.texts.items() if query in text]
+        
+        postings = sorted((self.postings.get(gram, set()) for gram in self.grams(query)), key=len)
+        candidates = set.intersection(*postings)
+        return sorted((key for key in candidates if query in self.texts[key]), key=self.order.__getitem__)
+
+# Searchable text of a product: its ID and name on separate lines, so a match
+# never spans both
+def product_search_text(product_id, product):
+    return f"{product_id}\n{product['name']}"
+
+# Name of a product, or "Unknown" for one that was deleted
+def product_name_of(product_id):
+    product = store.products.get(product_id)
+    return product['name'] if product else "Unknown"
+
+# Names of the distinct IDs in a column of product IDs, looked up once each
+def product_name_map(product_ids):
+    return {product_id: product_name_of(product_id) for product_id in pd.Series(product_ids).dropna().unique()}
+
+# Mutation journal
+# Every change to a collection goes through put_record/delete_record/append_record,
+# which update the shared data and queue one compact journal record.
+# flush_journal() hands the queued records to the storage engine, so the cost of
+# a save depends on the size of the change and not on the size of the data.
+def mark_dirty(collection):
+    store.versions[collection] += 1
+    store.dirty_collections.add(collection)
+
+def record_undo(*entry):
+    # Undo records are only needed while a batch can still be rolled back
+    if store.batch_depth > 0:
+        store.undo_log.append(entry)
+
+# Move a record between the index entries of its old and new field values
+def update_indexes(collection, key, old_value, new_value):
+    for field in INDEXED_FIELDS.get(collection, ()):
+        index = store.indexes[(collection, field)]
+        if old_value is not None:
+            keys = index.get(old_value.get(field))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[old_value.get(field)]
+        if new_value is not None:
+            index.setdefault(new_value.get(field), set()).add(key)
+    if collection == 'rfid_data':
+        store.inventory.update(key, new_value)
+    elif collection == 'products':
+        store.product_search.update(key, product_search_text(key, new_value) if new_value is not None else None)
+
+def rebuild_indexes():
+    store.inventory = InventoryView(store.rfid_data)
+    store.product_search = NgramIndex()
+    for product_id, product in store.products.items():
+        store.product_search.update(product_id, product_search_text(product_id, product))
+    store.indexes = {}
+    for collection, fields in INDEXED_FIELDS.items():
+        for field in fields:
+            index = {}
+            for key, value in store.data[collection].items():
+                index.setdefault(value.get(field), set()).add(key)
+            store.indexes[(collection, field)] = index
+
+# Add records to (sign 1) or remove them from (sign -1) the daily rollup of
+# their collection. A rollup maps the day number since 1970-01-01 to the rows
+# of that day keyed by their dimension values; a row holds [count, priced
+# count, revenue, {product_id: count}].
+def update_rollups(collection, records, sign=1):
+    if collection in ROLLUPS:
+        add_to_rollup(store.rollups[collection], collection, records, sign)
+
+def add_to_rollup(rollup, collection, records, sign=1):
+    config = ROLLUPS[collection]
+    time_column = TIME_COLUMNS[collection]
+    for record in records:
+        key = tuple(record.get(field) for field in config['dimensions'])
+        value = record.get(config['revenue']) if 'revenue' in config else None
+        add_rollup_row(rollup, record[time_column] // SECONDS_PER_DAY, key, sign,
+                       sign if value is not None else 0, sign * value if value is not None else 0.0,
+                       [(record.get('product_id'), sign)])
+
+def add_rollup_row(rollup, day, key, count, priced, revenue, products):
+    rows = rollup.setdefault(day, {})
+    row = rows.setdefault(key, [0, 0, 0.0, {}])
+    row[0] += count
+    row[1] += priced
+    row[2] += revenue
+    for product_id, product_count in products:
+        product_count += row[3].get(product_id, 0)
+        if product_count:
+            row[3][product_id] = product_count
+        else:
+            del row[3][product_id]
+    if row[0] == 0:
+        del rows[key]
+        if not rows:
+            del rollup[day]
+
+# Rollups of the archived records plus the hot records
+def rebuild_rollups():
+    archived = load_archive_rollups()
+    store.rollups = {collection: {day: {key: row[:3] + [dict(row[3])] for key, row in rows.items()}
+                                  for day, rows in archived[collection].items()}
+                     for collection in ROLLUPS}
+    for collection in ROLLUPS:
+        update_rollups(collection, store.data[collection])
+
+# Keys of the records whose field has the given value, e.g. all RFIDs in a branch
+def indexed_keys(collection, field, value):
+    return list(store.indexes[(collection, field)].get(value, ()))
+
+def put_record(collection, key, value):
+    data = store.data[collection]
+    record_undo('restore', collection, key, data[key] if key in data else None, key in data)
+    update_indexes(collection, key, data.get(key), value)
+    data[key] = value
+    store.pending_journal.append({'c': collection, 'op': 'put', 'k': key, 'v': value})
+    mark_dirty(collection)
+
+def delete_record(collection, key):
+    data = store.data[collection]
+    if isinstance(data, list):
+        record_undo('insert', collection, data.index(key), key)
+        data.remove(key)
+    else:
+        record_undo('restore', collection, key, data[key], True)
+        update_indexes(collection, key, data[key], None)
+        del data[key]
+    store.pending_journal.append({'c': collection, 'op': 'del', 'k': key})
+    mark_dirty(collection)
+
+def append_record(collection, record):
+    data = store.data[collection]
+    # The position makes replaying the record idempotent
+    store.pending_journal.append({'c': collection, 'op': 'append', 'i': len(data), 'v': record})
+    record_undo('pop', collection)
+    data.append(record)
+    update_rollups(collection, [record])
+    mark_dirty(collection)
+
+# Bulk variants of put_record/append_record/delete_record that write a single journal record
+def put_records(collection, values):
+    if not values:
+        return
+    data = store.data[collection]
+    for key, value in values.items():
+        record_undo('restore', collection, key, data[key] if key in data else None, key in data)
+        update_indexes(collection, key, data.get(key), value)
+        data[key] = value
+    store.pending_journal.append({'c': collection, 'op': 'put_many', 'v': values})
+    mark_dirty(collection)
+
+def extend_records(collection, records):
+    if not records:
+        return
+    data = store.data[collection]
+    store.pending_journal.append({'c': collection, 'op': 'extend', 'i': len(data), 'v': records})
+    record_undo('truncate', collection, len(data))
+    data.extend(records)
+    update_rollups(collection, records)
+    mark_dirty(collection)
+
+def delete_records(collection, keys):
+    if not keys:
+        return
+    data = store.data[collection]
+    for key in keys:
+        record_undo('restore', collection, key, data[key], True)
+        update_indexes(collection, key, data[key], None)
+        del data[key]
+    store.pending_journal.append({'c': collection, 'op': 'del_many', 'k': keys})
+    mark_dirty(collection)
+
+def apply_journal_record(data, entry):
+    collection = data[entry['c']]
+    if entry['op'] == 'put':
+        collection[entry['k']] = entry['v']
+    elif entry['op'] == 'del':
+        if isinstance(collection, list):
+            if entry['k'] in collection:
+                collection.remove(entry['k'])
+        else:
+            collection.pop(entry['k'], None)
+    elif entry['op'] == 'append':
+        # Skip records that were already folded into the snapshot
+        if len(collection) <= entry['i']:
+            collection.append(entry['v'])
+    elif entry['op'] == 'extend':
+        collection.extend(entry['v'][max(len(collection) - entry['i'], 0):])
+    elif entry['op'] == 'put_many':
+        collection.update(entry['v'])
+    elif entry['op'] == 'del_many':
+        for key in entry['k']:
+            collection.pop(key, None)
+
+# Storage engines
+# Both engines receive the same journal records from flush_journal(). load() fills
+# the given collections dict and returns the collections that differ from their
+# snapshot together with the number of records pending compaction.
+class JsonStorage:
+    def __init__(self):
+        self.data = default_collections()
+    
+    def load(self, data):
+        self.data = data
+        for collection, path in DATA_COLLECTIONS.items():
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    data[collection] = json.load(f)
+        
+        journaled = set()
+        count = 0
+        if os.path.exists(JOURNAL_PATH):
+            with open(JOURNAL_PATH, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn last line from an interrupted write
+                        continue
+                    apply_journal_record(data, entry)
+                    journaled.add(entry['c'])
+                    count += 1
         
-        with open(PRODUCTS_PATH, 'w', encoding='utf-8') as f:
-            json.dump(st.session_state.products, f, ensure_ascii=False, indent=2)
+        migrated = migrate_timestamps(data)
+        if migrated:
+            # Save the converted collections so older strings are parsed only once
+            self.compact(data, journaled | migrated)
+            return set(), 0
+        return journaled, count
+    
+    def write(self, entries):
+        lines = ''.join(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n' for entry in entries)
+        with open(JOURNAL_PATH, 'a', encoding='utf-8') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+    
+    # Fold the journal into the snapshot files and start a new journal.
+    # Only collections changed since their last snapshot are rewritten.
+    def compact(self, data, dirty_collections):
+        for collection in list(dirty_collections):
+            self.write_snapshot(collection, data[collection])
+            dirty_collections.discard(collection)
         
-        with open(CATEGORIES_PATH, 'w', encoding='utf-8') as f:
-            json.dump(st.session_state.categories, f, ensure_ascii=False, indent=2)
+        # Replaying is idempotent, so a crash before this point only leaves extra journal records
+        with open(JOURNAL_PATH, 'w', encoding='utf-8'):
+            pass
+    
+    # Changes whenever any data file is written, by this or another process
+    def disk_version(self):
+        version = []
+        for path in list(DATA_COLLECTIONS.values()) + [JOURNAL_PATH]:
+            try:
+                stat = os.stat(path)
+                version.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+    
+    # Write a collection's snapshot to a temporary file and swap it in atomically
+    def write_snapshot(self, collection, value):
+        path = DATA_COLLECTIONS[collection]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    
+    # Drop the first count records of a history collection after they were
+    # archived. The journal was compacted before archiving, so the snapshot
+    # holds all of the collection's records.
+    def trim(self, collection, count):
+        self.write_snapshot(collection, self.data[collection][count:])
+    
+    def select(self, collection, start=None, end=None, filters=None):
+        column = TIME_COLUMNS[collection]
+        filters = {field: set(values) for field, values in (filters or {}).items()}
+        # Copying the list is atomic, so a writer appending meanwhile is not seen halfway
+        records = [record for record in list(self.data[collection])
+                   if (start is None or record[column] >= start)
+                   and (end is None or record[column] <= end)
+                   and all(record.get(field) in values for field, values in filters.items())]
+        return pd.DataFrame(records)
+
+class SqliteStorage:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rfid_data (
+            rfid TEXT PRIMARY KEY, product_id TEXT, category TEXT, branch_id TEXT, added_at INTEGER);
+        CREATE INDEX IF NOT EXISTS rfid_data_branch ON rfid_data (branch_id);
+        CREATE INDEX IF NOT EXISTS rfid_data_product ON rfid_data (product_id);
+        CREATE TABLE IF NOT EXISTS sales (
+            position INTEGER PRIMARY KEY, rfid TEXT, product_id TEXT, product_name TEXT,
+            category TEXT, branch_id TEXT, sale_date INTEGER, sale_price REAL);
+        CREATE INDEX IF NOT EXISTS sales_date ON sales (sale_date);
+        CREATE INDEX IF NOT EXISTS sales_branch ON sales (branch_id, sale_date);
+        CREATE INDEX IF NOT EXISTS sales_category ON sales (category, sale_date);
+        CREATE TABLE IF NOT EXISTS transactions (
+            position INTEGER PRIMARY KEY, rfid TEXT, product_id TEXT, branch_id TEXT,
+            from_branch_id TEXT, to_branch_id TEXT, action TEXT, timestamp INTEGER);
+        CREATE INDEX IF NOT EXISTS transactions_timestamp ON transactions (timestamp);
+        CREATE INDEX IF NOT EXISTS transactions_rfid ON transactions (rfid);
+        CREATE INDEX IF NOT EXISTS transactions_action ON transactions (action, timestamp);
+        CREATE TABLE IF NOT EXISTS transfers (
+            position INTEGER PRIMARY KEY, rfid TEXT, product_id TEXT, product_name TEXT,
+            from_branch_id TEXT, to_branch_id TEXT, timestamp INTEGER);
+        CREATE INDEX IF NOT EXISTS transfers_timestamp ON transfers (timestamp);
+        CREATE INDEX IF NOT EXISTS transfers_from ON transfers (from_branch_id, timestamp);
+        CREATE INDEX IF NOT EXISTS transfers_to ON transfers (to_branch_id, timestamp);
+        CREATE TABLE IF NOT EXISTS categories (name TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS records (
+            collection TEXT, key TEXT, value TEXT, PRIMARY KEY (collection, key));
+    """
+    RFID_COLUMNS = ['product_id', 'category', 'branch_id', 'added_at']
+    # Columns of the tables holding the history collections
+    LIST_COLUMNS = HISTORY_COLUMNS
+    
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self.is_new = not os.path.exists(path)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # Reading connections, one per thread, which only see committed data
+        self.readers = threading.local()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+    
+    def load(self, data):
+        if self.is_new:
+            # One-shot migration of the JSON files into the new database
+            migrate_json_to_sqlite(data, self)
+            self.is_new = False
         
-        with open(TRANSACTIONS_PATH, 'w', encoding='utf-8') as f:
-            json.dump(st.session_state.transactions, f, ensure_ascii=False, indent=2)
+        data['rfid_data'] = {row[0]: dict(zip(self.RFID_COLUMNS, row[1:]))
+                             for row in self.conn.execute("SELECT rfid, product_id, category, branch_id, added_at FROM rfid_data")}
+        for collection, columns in self.LIST_COLUMNS.items():
+            data[collection] = self.fetch_records(collection, f"SELECT {', '.join(columns)} FROM {collection} ORDER BY position")
+        data['categories'] = [row[0] for row in self.conn.execute("SELECT name FROM categories ORDER BY rowid")]
+        for collection in ('products', 'branches', 'users'):
+            rows = self.conn.execute("SELECT key, value FROM records WHERE collection = ?", (collection,)).fetchall()
+            if rows:
+                data[collection] = {key: json.loads(value) for key, value in rows}
+        return set(), 0
+    
+    def fetch_records(self, collection, query, params=(), conn=None):
+        columns = self.LIST_COLUMNS[collection]
+        records = []
+        for row in (conn or self.conn).execute(query, params):
+            record = dict(zip(columns, row))
+            if collection == 'transactions':
+                # Transactions only carry the branch fields of their action
+                record = {field: value for field, value in record.items() if value is not None}
+            records.append(record)
+        return records
+    
+    def write(self, entries):
+        with self.conn:
+            for entry in entries:
+                self.apply(entry)
+    
+    def apply(self, entry):
+        collection, op = entry['c'], entry['op']
+        if op == 'del_many':
+            for key in entry['k']:
+                self.apply({'c': collection, 'op': 'del', 'k': key})
+        elif op == 'put_many':
+            if collection == 'rfid_data':
+                self.conn.executemany("INSERT OR REPLACE INTO rfid_data VALUES (?, ?, ?, ?, ?)",
+                                      ([key] + [value.get(column) for column in self.RFID_COLUMNS] for key, value in entry['v'].items()))
+            else:
+                self.conn.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?)",
+                                      ((collection, key, json.dumps(value, ensure_ascii=False)) for key, value in entry['v'].items()))
+        elif collection == 'rfid_data':
+            if op == 'put':
+                value = entry['v']
+                self.conn.execute("INSERT OR REPLACE INTO rfid_data VALUES (?, ?, ?, ?, ?)",
+                                  [entry['k']] + [value.get(column) for column in self.RFID_COLUMNS])
+            else:
+                self.conn.execute("DELETE FROM rfid_data WHERE rfid = ?", (entry['k'],))
+        elif collection in self.LIST_COLUMNS:
+            columns = self.LIST_COLUMNS[collection]
+            records = entry['v'] if op == 'extend' else [entry['v']]
+            # The journal position doubles as primary key, which keeps replays idempotent
+            self.conn.executemany(
+                f"INSERT OR IGNORE INTO {collection} (position, {', '.join(columns)}) VALUES ({', '.join('?' * (len(columns) + 1))})",
+                ([entry['i'] + offset] + [record.get(column) for column in columns] for offset, record in enumerate(records)))
+        elif collection == 'categories':
+            if op in ('append', 'extend'):
+                names = entry['v'] if op == 'extend' else [entry['v']]
+                self.conn.executemany("INSERT OR IGNORE INTO categories (name) VALUES (?)", ((name,) for name in names))
+            else:
+                self.conn.execute("DELETE FROM categories WHERE name = ?", (entry['k'],))
+        elif op == 'put':
+            self.conn.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?)",
+                              (collection, entry['k'], json.dumps(entry['v'], ensure_ascii=False)))
+        else:
+            self.conn.execute("DELETE FROM records WHERE collection = ? AND key = ?", (collection, entry['k']))
+    
+    # The database is always up to date; compaction only checkpoints the WAL
+    def compact(self, data, dirty_collections):
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        dirty_collections.clear()
+    
+    # Reads outside the write lock use their own connection, as the shared one
+    # may be inside another thread's uncommitted transaction
+    def read_connection(self):
+        if getattr(self.readers, 'conn', None) is None:
+            self.readers.conn = sqlite3.connect(self.path)
+        return self.readers.conn
+    
+    # Changes when another connection commits to the database
+    def disk_version(self):
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+    
+    # Drop the first count records of a history collection after they were
+    # archived and renumber the rest, so positions keep matching list indexes
+    def trim(self, collection, count):
+        with self.conn:
+            self.conn.execute(f"DELETE FROM {collection} WHERE position < ?", (count,))
+            # Through negative positions so no intermediate position collides
+            self.conn.execute(f"UPDATE {collection} SET position = ? - 1 - position", (count,))
+            self.conn.execute(f"UPDATE {collection} SET position = -1 - position")
+    
+    def select(self, collection, start=None, end=None, filters=None):
+        column = TIME_COLUMNS[collection]
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append(f"{column} >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append(f"{column} <= ?")
+            params.append(end)
+        for field, values in (filters or {}).items():
+            values = list(values)
+            conditions.append(f"{field} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+        
+        query = f"SELECT {', '.join(self.LIST_COLUMNS[collection])} FROM {collection}"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY position"
+        return pd.DataFrame(self.fetch_records(collection, query, params, self.read_connection()))
+
+STORAGE_BACKENDS = {
+    'json': JsonStorage,
+    'sqlite': SqliteStorage
+}
+
+# The shared store, created once per server process
+@st.cache_resource
+def get_data_store():
+    return DataStore(STORAGE_BACKENDS[STORAGE_BACKEND]())
+
+# Copy the JSON snapshot files and journal into a SQLite database
+def migrate_json_to_sqlite(data, target):
+    JsonStorage().load(data)
+    
+    entries = []
+    for collection in DATA_COLLECTIONS:
+        value = data[collection]
+        if isinstance(value, dict):
+            entries.extend({'c': collection, 'op': 'put', 'k': key, 'v': record} for key, record in value.items())
+        else:
+            entries.append({'c': collection, 'op': 'extend', 'i': 0, 'v': value})
+    target.write(entries)
+
+# Date range of a history collection, archive included, as (first, last)
+# dates, or None if it is empty
+def history_date_range(collection):
+    with store.lock:
+        days = list(store.rollups[collection])
+    if not days:
+        return None
+    return tuple(np.datetime64(day, 'D').astype(datetime) for day in (min(days), max(days)))
+
+# Records of a history collection between two dates (inclusive) as a DataFrame
+# with a datetime64 time column. Archived months are only read when the date
+# range reaches them.
+def query_history(collection, start_date=None, end_date=None, filters=None):
+    start = to_epoch(start_date) if start_date is not None else None
+    end = to_epoch(end_date) + SECONDS_PER_DAY - 1 if end_date is not None else None
+    frame = store.storage.select(collection, start, end, filters)
+    archived = read_archive(collection, start, end, filters)
+    if archived is not None:
+        frame = pd.concat([archived, frame], ignore_index=True)
+    column = TIME_COLUMNS[collection]
+    if column in frame:
+        frame[column] = frame[column].to_numpy(dtype=np.int64).view('datetime64[s]')
+    return frame
+
+# History archive
+# Records older than ARCHIVE_AFTER_DAYS move from the front of the history
+# collections into month-partitioned Parquet files:
+#   data/archive/<collection>/month=YYYY-MM/<run>.parquet
+# The files of a run are written first and become visible once the run is listed
+# in the manifest. The hot collections are trimmed after that; a trim that was
+# interrupted is finished by the next load_data(). Each file carries the rollup
+# rows of its records in its metadata, so loading never reads archived records.
+def load_archive_manifest():
+    if not os.path.exists(ARCHIVE_MANIFEST_PATH):
+        return {'runs': [], 'pending': {}}
+    with open(ARCHIVE_MANIFEST_PATH, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_archive_manifest(manifest):
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    tmp_path = f"{ARCHIVE_MANIFEST_PATH}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, ARCHIVE_MANIFEST_PATH)
+
+def archive_schema(collection):
+    types = {'sale_price': pa.float64(), TIME_COLUMNS[collection]: pa.int64()}
+    return pa.schema([(column, types.get(column, pa.string())) for column in HISTORY_COLUMNS[collection]])
+
+# Month ("YYYY-MM") of each of an array of epoch seconds
+def epoch_months(epochs):
+    return np.asarray(epochs, dtype=np.int64).view('datetime64[s]').astype('datetime64[M]').astype(str)
+
+# Archive files of committed runs, optionally only of the months from start to end
+def archive_files(collection, start=None, end=None):
+    runs = set(store.archive_runs)
+    first = epoch_months([start])[0] if start is not None else None
+    last = epoch_months([end])[0] if end is not None else None
+    files = []
+    for path in sorted(glob.glob(os.path.join(ARCHIVE_DIR, collection, 'month=*', '*.parquet'))):
+        month = os.path.basename(os.path.dirname(path))[len('month='):]
+        if os.path.splitext(os.path.basename(path))[0] not in runs:
+            continue
+        if (first is None or month >= first) and (last is None or month <= last):
+            files.append(path)
+    return files
+
+# Archived records matching the date range and filters, or None if no archived
+# month overlaps the range. Filters are pushed down to the Parquet reader.
+def read_archive(collection, start=None, end=None, filters=None):
+    files = archive_files(collection, start, end)
+    if not files:
+        return None
+    
+    column = ds.field(TIME_COLUMNS[collection])
+    condition = None
+    conditions = ([column >= start] if start is not None else []) + ([column <= end] if end is not None else [])
+    conditions += [ds.field(field).isin(list(values)) for field, values in (filters or {}).items()]
+    for part in conditions:
+        condition = part if condition is None else condition & part
+    
+    dataset = ds.dataset(files, schema=archive_schema(collection), format='parquet')
+    frame = dataset.to_table(filter=condition).to_pandas()
+    return frame.sort_values(TIME_COLUMNS[collection], kind='stable', ignore_index=True)
+
+# Rollups of all archived records, read from the file metadata and cached per
+# set of committed runs
+def load_archive_rollups():
+    runs = tuple(store.archive_runs)
+    if store.archive_rollups[0] == runs:
+        return store.archive_rollups[1]
+    
+    rollups = {collection: {} for collection in ROLLUPS}
+    for collection in ROLLUPS:
+        for path in archive_files(collection):
+            rows = json.loads(pq.read_schema(path).metadata[b'rollup'])
+            rollup = rollups[collection]
+            for row in rows:
+                add_rollup_row(rollup, row[0], tuple(row[1:-4]), *row[-4:])
+    store.archive_rollups = (runs, rollups)
+    return rollups
+
+# Write the records of one run into a file per month
+def write_archive_files(collection, records, run):
+    column = TIME_COLUMNS[collection]
+    months = {}
+    for month, record in zip(epoch_months([record[column] for record in records]), records):
+        months.setdefault(month, []).append(record)
+    
+    for month, month_records in months.items():
+        directory = os.path.join(ARCHIVE_DIR, collection, f"month={month}")
+        os.makedirs(directory, exist_ok=True)
+        write_archive_file(collection, month_records, os.path.join(directory, f"{run}.parquet"))
+
+def write_archive_file(collection, records, path):
+    rollup = {}
+    add_to_rollup(rollup, collection, records)
+    rows = [[day] + list(key) + row[:3] + [list(row[3].items())] for day, day_rows in rollup.items() for key, row in day_rows.items()]
+    table = pa.Table.from_pylist(records, schema=archive_schema(collection)).replace_schema_metadata(
+        {'rollup': json.dumps(rows, ensure_ascii=False)})
+    pq.write_table(table, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+# Trim the hot collections for committed runs whose trim has not completed
+def apply_pending_archives(manifest):
+    for run, trims in list(manifest['pending'].items()):
+        for collection, trim in trims.items():
+            records = store.data[collection]
+            count = trim['count']
+            # Only trim if the last archived record is still in place
+            if len(records) >= count and records[count - 1] == trim['last']:
+                store.storage.trim(collection, count)
+                del records[:count]
+                store.versions[collection] += 1
+        del manifest['pending'][run]
+        write_archive_manifest(manifest)
+
+# Move the history records older than ARCHIVE_AFTER_DAYS into the archive.
+# Only the oldest run of records of each collection is moved, so the hot
+# collections stay in order.
+def archive_history():
+    store.archive_checked = datetime.now().date()
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return
+    
+    cutoff = to_epoch((datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)).date())
+    with store.lock:
+        try:
+            # Bring the storage up to date so trimmed collections can be written as a whole
+            flush_journal()
+            store.storage.compact(store.data, store.dirty_collections)
+            store.journal_length = 0
+            
+            run = f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+            trims = {}
+            for collection, column in TIME_COLUMNS.items():
+                records = store.data[collection]
+                count = 0
+                while count < len(records) and records[count][column] < cutoff:
+                    count += 1
+                if count:
+                    write_archive_files(collection, records[:count], run)
+                    trims[collection] = {'count': count, 'last': records[count - 1]}
+            if not trims:
+                return
+            
+            manifest = load_archive_manifest()
+            manifest['runs'].append(run)
+            manifest['pending'][run] = trims
+            write_archive_manifest(manifest)
+            store.archive_runs = list(manifest['runs'])
             
-        with open(SALES_PATH, 'w', encoding='utf-8') as f:
-            json.dump(st.session_state.sales, f, ensure_ascii=False, indent=2)
+            apply_pending_archives(manifest)
+            store.disk_version = store.storage.disk_version()
+        except Exception as e:
+            st.error(f"Error archiving history: {str(e)}")
+
+# Rollup rows of a history collection between two dates (inclusive) whose
+# dimensions match the filters, as (day, key, row). Only the rows of the days in
+# the range are visited. Call with store.lock held.
+def rollup_rows(collection, start_date=None, end_date=None, filters=None):
+    dimensions = ROLLUPS[collection]['dimensions']
+    first = to_epoch(start_date) // SECONDS_PER_DAY if start_date is not None else None
+    last = to_epoch(end_date) // SECONDS_PER_DAY if end_date is not None else None
+    conditions = [(dimensions.index(field), set(values)) for field, values in (filters or {}).items()]
+    for day, rows in store.rollups[collection].items():
+        if (first is not None and day < first) or (last is not None and day > last):
+            continue
+        for key, row in rows.items():
+            if all(key[i] in values for i, values in conditions):
+                yield day, key, row
+
+# Daily rollup rows of a history collection between two dates (inclusive) as a
+# DataFrame with a datetime64 'date' column, the dimension columns, 'count' and,
+# for collections with revenue, 'priced' and 'revenue'
+def rollup_frame(collection, start_date=None, end_date=None, filters=None):
+    config = ROLLUPS[collection]
+    with store.lock:
+        rows = [(day,) + key + tuple(row[:3]) for day, key, row in rollup_rows(collection, start_date, end_date, filters)]
+    columns = ['date'] + config['dimensions'] + ['count', 'priced', 'revenue']
+    frame = pd.DataFrame(rows, columns=columns)
+    
+    frame['date'] = frame['date'].to_numpy(dtype=np.int64).astype('datetime64[D]').astype('datetime64[ns]')
+    if 'revenue' not in config:
+        frame = frame.drop(columns=['priced', 'revenue'])
+    return frame.sort_values('date', ignore_index=True)
+
+# Number of distinct products among the records of a history collection
+# between two dates (inclusive) that match the filters
+def rollup_product_count(collection, start_date=None, end_date=None, filters=None):
+    products = set()
+    with store.lock:
+        for _, _, row in rollup_rows(collection, start_date, end_date, filters):
+            products.update(row[3])
+    products.discard(None)
+    return len(products)
+
+# Load data from files if they exist
+def load_data():
+    with store.lock:
+        try:
+            data = default_collections()
+            journaled, journal_length = store.storage.load(data)
+            store.data = data
             
-        with open(BRANCHES_PATH, 'w', encoding='utf-8') as f:
-            json.dump(st.session_state.branches, f, ensure_ascii=False, indent=2)
+            manifest = load_archive_manifest()
+            store.archive_runs = list(manifest['runs'])
+            apply_pending_archives(manifest)
             
-        with open(TRANSFERS_PATH, 'w', encoding='utf-8') as f:
-            json.dump(st.session_state.transfers, f, ensure_ascii=False, indent=2)
+            rebuild_indexes()
+            rebuild_rollups()
             
-        with open(USERS_PATH, 'w', encoding='utf-8') as f:
-            json.dump(st.session_state.users, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        st.error(f"Error saving data: {str(e)}")
+            for collection in DATA_COLLECTIONS:
+                store.versions[collection] += 1
+            store.dirty_collections = set(journaled)
+            store.journal_length = journal_length
+            store.disk_version = store.storage.disk_version()
+        except Exception as e:
+            st.error(f"Error loading data: {str(e)}")
+
+# Reload the shared data only if the storage changed since it was loaded
+def refresh_data():
+    # Under the lock, as the SQLite engine's connection may be inside a writer's transaction
+    with store.lock:
+        if store.storage.disk_version() != store.disk_version:
+            load_data()
+
+# Hand the pending mutations to the storage engine
+def flush_journal():
+    pending = store.pending_journal
+    if not pending:
+        return
+    
+    store.storage.write(pending)
+    
+    store.journal_length += len(pending)
+    pending.clear()
+    
+    if store.journal_length >= JOURNAL_COMPACT_THRESHOLD:
+        compact_data()
+    store.disk_version = store.storage.disk_version()
+
+# Undo the in-memory changes recorded after the given undo log position
+def rollback_to(undo_position):
+    undo_log = store.undo_log
+    while len(undo_log) > undo_position:
+        action, collection, *args = undo_log.pop()
+        data = store.data[collection]
+        if action == 'restore':
+            key, old_value, existed = args
+            update_indexes(collection, key, data.get(key), old_value if existed else None)
+            if existed:
+                data[key] = old_value
+            else:
+                data.pop(key, None)
+        elif action == 'insert':
+            index, value = args
+            data.insert(index, value)
+        elif action == 'pop':
+            update_rollups(collection, [data.pop()], -1)
+        elif action == 'truncate':
+            update_rollups(collection, data[args[0]:], -1)
+            del data[args[0]:]
+        mark_dirty(collection)
+
+# Unit of work for bulk operations: mutations inside the block are applied in
+# memory and saved with a single journal write when the outermost block exits.
+# If the block raises, or the final save fails, every change made inside it is
+# rolled back. Blocks can be nested; an inner block that raises only undoes its
+# own changes. The block holds the store's write lock, so writers from other
+# sessions wait until it has been saved.
+@contextmanager
+def data_batch():
+    with store.lock:
+        undo_position = len(store.undo_log)
+        pending_position = len(store.pending_journal)
+        store.batch_depth += 1
+        try:
+            yield
+        except BaseException:
+            store.batch_depth -= 1
+            rollback_to(undo_position)
+            del store.pending_journal[pending_position:]
+            raise
+        
+        store.batch_depth -= 1
+        if store.batch_depth == 0:
+            try:
+                flush_journal()
+            except Exception as e:
+                rollback_to(undo_position)
+                del store.pending_journal[pending_position:]
+                raise SaveError(str(e)) from e
+            except BaseException:
+                rollback_to(undo_position)
+                del store.pending_journal[pending_position:]
+                raise
+            finally:
+                store.undo_log.clear()
+
+# Raised by data_batch() when the storage engine fails to save a batch; its
+# changes have been rolled back
+class SaveError(Exception):
+    pass
+
+# Run a mutator as its own unit of work under the write lock. A failed save is
+# reported as (False, message); other exceptions are bugs and propagate after
+# the mutator's changes were rolled back.
+def write_operation(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            with data_batch():
+                return func(*args, **kwargs)
+        except SaveError as e:
+            return False, f"Error saving data: {str(e)}"
+    return wrapper
+
+def compact_data():
+    with store.lock:
+        try:
+            store.storage.compact(store.data, store.dirty_collections)
+            store.journal_length = 0
+        except Exception as e:
+            st.error(f"Error compacting data: {str(e)}")
 
 # Authentication functions
 def hash_password(password):
@@ -159,8 +1395,8 @@ def verify_password(password, hashed_password):
     return hash_password(password) == hashed_password
 
 def authenticate_user(username, password):
-    if username in st.session_state.users:
-        user = st.session_state.users[username]
+    if username in store.users:
+        user = store.users[username]
         
         # Ensure admin user always has all permissions
         if username == "admin" and user.get('role') == "admin" and 'permissions' not in user:
@@ -182,8 +1418,9 @@ def require_permission(permission):
         return False
     return True
 # User management functions
+@write_operation
 def add_user(username, password, role, permissions=None, name=None):
-    if username in st.session_state.users:
+    if username in store.users:
         return False, f"User {username} already exists"
     
     if permissions is None:
@@ -192,23 +1429,23 @@ def add_user(username, password, role, permissions=None, name=None):
     if name is None:
         name = username.capitalize()
     
-    st.session_state.users[username] = {
+    put_record('users', username, {
         "password": hash_password(password),
         "role": role,
         "permissions": permissions,
-        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "created_at": now_epoch(),
         "active": True,
         "created_by": st.session_state.current_user,
         "name": name
-    }
-    save_data()
+    })
     return True, f"User {username} created successfully"
 
+@write_operation
 def update_user(username, password=None, role=None, permissions=None, active=None, name=None):
-    if username not in st.session_state.users:
+    if username not in store.users:
         return False, f"User {username} not found"
     
-    user = st.session_state.users[username]
+    user = dict(store.users[username])
     if password:
         user['password'] = hash_password(password)
     if role:
@@ -220,44 +1457,45 @@ def update_user(username, password=None, role=None, permissions=None, active=Non
     if name:
         user['name'] = name
     
-    user['modified_at'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    user['modified_at'] = now_epoch()
     user['modified_by'] = st.session_state.current_user
     
-    save_data()
+    put_record('users', username, user)
     return True, f"User {username} updated successfully"
 
+@write_operation
 def delete_user(username):
-    if username not in st.session_state.users:
+    if username not in store.users:
         return False, f"User {username} not found"
     
     if username == "admin":
         return False, "Cannot delete admin user"
     
-    del st.session_state.users[username]
-    save_data()
+    delete_record('users', username)
     return True, f"User {username} deleted successfully"
 
 # RFID and Product Management Functions
+@write_operation
 def add_rfid_tag(rfid, product_id, category, branch_id=None, timestamp=None):
     if timestamp is None:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        timestamp = now_epoch()
     
     # Default to current branch if not specified
     if branch_id is None:
         branch_id = st.session_state.current_branch
     
-    if rfid in st.session_state.rfid_data:
-        return False, f"RFID tag {rfid} already exists for product {st.session_state.rfid_data[rfid]['product_id']}"
+    if rfid in store.rfid_data:
+        return False, f"RFID tag {rfid} already exists for product {store.rfid_data[rfid]['product_id']}"
     
-    st.session_state.rfid_data[rfid] = {
+    put_record('rfid_data', rfid, {
         'product_id': product_id,
         'category': category,
         'branch_id': branch_id,
         'added_at': timestamp
-    }
+    })
     
     # Add to transactions
-    st.session_state.transactions.append({
+    append_record('transactions', {
         'rfid': rfid,
         'product_id': product_id,
         'branch_id': branch_id,
@@ -265,92 +1503,223 @@ def add_rfid_tag(rfid, product_id, category, branch_id=None, timestamp=None):
         'timestamp': timestamp
     })
     
-    save_data()
     return True, f"RFID tag {rfid} added successfully"
-def process_excel(df):
-    results = []
-    for _, row in df.iterrows():
-        try:
-            rfid = str(row['rfid']).strip()
-            if rfid in st.session_state.rfid_data:
-                product_id = st.session_state.rfid_data[rfid]['product_id']
-                product_name = st.session_state.products[product_id]['name'] if product_id in st.session_state.products else "Unknown"
-                results.append({
-                    'rfid': rfid,
-                    'status': 'existing',
-                    'message': f"Tag already exists for product {product_name} (ID: {product_id})"
-                })
-            else:
-                results.append({
-                    'rfid': rfid,
-                    'status': 'new',
-                    'message': "New RFID tag"
-                })
-        except Exception as e:
-            results.append({
-                'rfid': rfid if 'rfid' in locals() else "Error",
-                'status': 'error',
-                'message': str(e)
-            })
+# Classify the RFID tags of an uploaded file as new, existing, duplicate
+# (repeated within the file) or error, as a DataFrame with one row per file row
+def process_excel(df, seen=None):
+    rfid_data = store.rfid_data
+    
+    missing = df['rfid'].isna()
+    rfids = df['rfid'].astype(str).str.strip()
+    missing |= rfids == ''
+    rfids = rfids.mask(missing, "Error")
+    
+    duplicate = ~missing & rfids.duplicated(keep='first')
+    # Tags already met in earlier chunks of the same file
+    if seen is not None:
+        duplicate |= ~missing & rfids.isin(seen)
+        seen.update(rfids[~missing])
+    existing = ~missing & ~duplicate & rfids.isin(rfid_data.keys())
+    
+    results = pd.DataFrame({
+        'rfid': rfids,
+        'status': 'new',
+        'message': "New RFID tag"
+    }, index=df.index)
+    
+    if existing.any():
+        # Join product names once per distinct product
+        product_ids = rfids[existing].map(lambda rfid: rfid_data[rfid]['product_id'] if rfid in rfid_data else "Unknown")
+        results.loc[existing, 'status'] = 'existing'
+        results.loc[existing, 'message'] = ("Tag already exists for product " + product_ids.map(product_name_map(product_ids))
+                                            + " (ID: " + product_ids + ")")
+    
+    results.loc[duplicate, 'status'] = 'duplicate'
+    results.loc[duplicate, 'message'] = "RFID tag appears more than once in the file"
+    results.loc[missing, 'status'] = 'error'
+    results.loc[missing, 'message'] = "Missing RFID tag in row"
     
     return results
 
+# Product images
+# An uploaded image is saved as a JPEG plus one scaled-down JPEG per entry of
+# IMAGE_VARIANTS. Files are named after the hash of the encoded image, so the
+# same upload is stored once however many products use it.
+def write_image_file(path, data):
+    if os.path.exists(path):
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def encode_jpeg(image, size=None):
+    if size is not None:
+        image = image.copy()
+        image.thumbnail((size, size))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+# Decode an uploaded image file upright and no larger than IMAGE_MAX_SIZE.
+# Large JPEGs are scaled down while decoding.
+def normalize_image(data):
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft('RGB', (IMAGE_MAX_SIZE, IMAGE_MAX_SIZE))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    image.thumbnail((IMAGE_MAX_SIZE, IMAGE_MAX_SIZE))
+    return image
+
+# Encode a PIL image and its variants; returns {product field: (path, data)}
+def encode_product_image(image):
+    data = encode_jpeg(image)
+    digest = hashlib.sha256(data).hexdigest()
+    files = {'image': (os.path.join(IMAGES_DIR, f"{digest}.jpg"), data)}
+    for variant, size in IMAGE_VARIANTS.items():
+        files[variant] = (os.path.join(IMAGES_DIR, f"{digest}_{variant}.jpg"), encode_jpeg(image, size))
+    return files
+
+# Write encoded image files; returns the product fields with their paths
+def write_product_image(files):
+    os.makedirs(IMAGES_DIR, exist_ok=True)
+    for path, data in files.values():
+        write_image_file(path, data)
+    return {field: path for field, (path, data) in files.items()}
+
+# Delete the image files of a product that no other product uses
+def delete_product_images(product_id, product):
+    for field in ['image'] + list(IMAGE_VARIANTS):
+        path = product.get(field)
+        if not path or not os.path.exists(path):
+            continue
+        if any(other.get(field) == path for other_id, other in store.products.items() if other_id != product_id):
+            continue
+        os.remove(path)
+
+# Encoded bytes of an image file, scaled down to size if given. Paths are
+# content hashes or carry a timestamp, so cached bytes never go stale. The
+# cache is process-wide, as app.py is run anew as a fresh module on every rerun.
+@st.cache_resource(max_entries=IMAGE_CACHE_SIZE, show_spinner=False)
+def image_file_bytes(path, size=None):
+    if size is None:
+        with open(path, 'rb') as f:
+            return f.read()
+    with Image.open(path) as image:
+        return encode_jpeg(image.convert('RGB'), size)
+
+# Encoded image variant of a product, or None if it has no image. Products
+# saved before variants existed are scaled down from the full image once.
+def product_image_bytes(product, variant):
+    path = product.get(variant)
+    if path and os.path.exists(path):
+        return image_file_bytes(path)
+    path = product.get('image')
+    if path and os.path.exists(path):
+        return image_file_bytes(path, IMAGE_VARIANTS[variant])
+    return None
+
+# Background image jobs
+# Uploaded images are decoded and encoded by worker threads, so a product is
+# saved at once and its image fields are filled in when the job finishes.
+# store.image_jobs holds the latest job of each product. Job files are written
+# and the product updated under the write lock; a job whose product was deleted
+# or given a newer image in the meantime is discarded.
+def queue_product_image(product_id, data):
+    job = {
+        'product_id': product_id,
+        'status': 'queued',
+        'error': None,
+        'submitted_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'finished_at': None
+    }
+    with store.lock:
+        store.image_jobs.pop(product_id, None)
+        store.image_jobs[product_id] = job
+        # Forget the oldest finished jobs beyond the history limit
+        excess = len(store.image_jobs) - IMAGE_JOB_HISTORY
+        if excess > 0:
+            finished = [pid for pid, other in store.image_jobs.items() if other['finished_at'] is not None]
+            for pid in finished[:excess]:
+                del store.image_jobs[pid]
+    job['future'] = store.image_executor.submit(process_product_image, product_id, data, job)
+    return job
+
+# Runs on a worker thread, so it reports through the job instead of st.* calls
+def process_product_image(product_id, data, job):
+    job['status'] = 'processing'
+    try:
+        files = encode_product_image(normalize_image(data))
+        with data_batch():
+            if product_id not in store.products or store.image_jobs.get(product_id) is not job:
+                job['status'] = 'discarded'
+                return
+            product = dict(store.products[product_id])
+            image_paths = write_product_image(files)
+            # Delete the old images unless they are the same files
+            if product.get('image') != image_paths['image']:
+                delete_product_images(product_id, product)
+            product.update(image_paths)
+            put_record('products', product_id, product)
+        job['status'] = 'done'
+    except Exception as e:
+        job['status'] = 'failed'
+        job['error'] = str(e)
+    finally:
+        job['finished_at'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+# Latest image job of a product that is still running or has failed, or None
+def pending_image_job(product_id):
+    job = store.image_jobs.get(product_id)
+    if job is not None and job['status'] in ('queued', 'processing', 'failed'):
+        return job
+    return None
+
 # Product Functions
+@write_operation
 def add_product(product_id, name, description, category, image=None):
-    if product_id in st.session_state.products:
+    if product_id in store.products:
         return False, f"Product ID {product_id} already exists"
     
-    image_path = None
-    if image is not None:
-        try:
-            # Create a unique filename with timestamp and product_id
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            image_filename = f"data/images/{product_id}_{timestamp}.jpg"
-            # Ensure directory exists
-            os.makedirs(os.path.dirname(image_filename), exist_ok=True)
-            # Save the image
-            image.save(image_filename)
-            image_path = image_filename
-        except Exception as e:
-            return False, f"Failed to save image: {str(e)}"
-    
-    st.session_state.products[product_id] = {
+    put_record('products', product_id, {
         'name': name,
         'description': description,
         'category': category,
-        'image': image_path
-    }
+        'image': None
+    })
+    
     
-    save_data()
+    # The uploaded image file is processed in the background
+    if image is not None:
+        queue_product_image(product_id, image)
+        return True, f"Product {name} added successfully. Its image is being processed."
     return True, f"Product {name} added successfully"
 
+@write_operation
 def delete_product(product_id):
-    if product_id not in st.session_state.products:
+    if product_id not in store.products:
         return False, f"Product ID {product_id} not found"
     
     # Check if there are RFID tags associated with this product
-    associated_rfids = [rfid for rfid, data in st.session_state.rfid_data.items() if data['product_id'] == product_id]
+    associated_rfids = indexed_keys('rfid_data', 'product_id', product_id)
     if associated_rfids:
         return False, f"Cannot delete product with {len(associated_rfids)} associated RFID tags. Remove the tags first."
     
-    # Get the image path to delete the file
-    image_path = st.session_state.products[product_id].get('image')
-    if image_path and os.path.exists(image_path):
-        try:
-            os.remove(image_path)
-        except Exception as e:
-            # Log the error but continue with deletion
-            st.warning(f"Error deleting product image: {str(e)}")
+    # Delete the image files
+    try:
+        delete_product_images(product_id, store.products[product_id])
+    except Exception as e:
+        # Log the error but continue with deletion
+        st.warning(f"Error deleting product image: {str(e)}")
     
-    del st.session_state.products[product_id]
-    save_data()
+    delete_record('products', product_id)
     return True, f"Product {product_id} deleted successfully"
 
+@write_operation
 def update_product(product_id, name=None, description=None, category=None, image=None):
-    if product_id not in st.session_state.products:
+    if product_id not in store.products:
         return False, f"Product ID {product_id} not found"
     
-    product = st.session_state.products[product_id]
+    product = dict(store.products[product_id])
     
     if name is not None:
         product['name'] = name
@@ -361,82 +1730,73 @@ def update_product(product_id, name=None, description=None, category=None, image
     if category is not None:
         product['category'] = category
     
-    if image is not None:
-        try:
-            # Delete the old image if it exists
-            old_image_path = product.get('image')
-            if old_image_path and os.path.exists(old_image_path):
-                os.remove(old_image_path)
-            
-            # Save the new image
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            image_filename = f"data/images/{product_id}_{timestamp}.jpg"
-            image.save(image_filename)
-            product['image'] = image_filename
-        except Exception as e:
-            return False, f"Failed to update image: {str(e)}"
+    put_record('products', product_id, product)
     
-    save_data()
+    # The current image is kept until the new one has been processed
+    if image is not None:
+        queue_product_image(product_id, image)
+        return True, f"Product {product_id} updated successfully. The new image is being processed."
     return True, f"Product {product_id} updated successfully"
 # Category Functions
+@write_operation
 def add_category(category_name):
-    if category_name in st.session_state.categories:
+    if category_name in store.categories:
         return False, f"Category {category_name} already exists"
     
-    st.session_state.categories.append(category_name)
-    save_data()
+    append_record('categories', category_name)
     return True, f"Category {category_name} added successfully"
 
+@write_operation
 def delete_category(category_name):
-    if category_name not in st.session_state.categories:
+    if category_name not in store.categories:
         return False, f"Category {category_name} not found"
     
     # Check if there are products in this category
-    products_in_category = [pid for pid, data in st.session_state.products.items() if data['category'] == category_name]
+    products_in_category = indexed_keys('products', 'category', category_name)
     if products_in_category:
         return False, f"Cannot delete category with {len(products_in_category)} associated products. Change their category first."
     
-    st.session_state.categories.remove(category_name)
-    save_data()
+    delete_record('categories', category_name)
     return True, f"Category {category_name} deleted successfully"
 
 # Branch Functions
+@write_operation
 def add_branch(branch_id, name, address):
-    if branch_id in st.session_state.branches:
+    if branch_id in store.branches:
         return False, f"Branch ID {branch_id} already exists"
     
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    timestamp = now_epoch()
     
-    st.session_state.branches[branch_id] = {
+    put_record('branches', branch_id, {
         'name': name,
         'address': address,
         'created_at': timestamp
-    }
+    })
     
-    save_data()
     return True, f"Branch {name} added successfully"
 
+@write_operation
 def delete_branch(branch_id):
-    if branch_id not in st.session_state.branches:
+    if branch_id not in store.branches:
         return False, f"Branch ID {branch_id} not found"
     
     if branch_id == "main":
         return False, "Cannot delete the main branch"
     
     # Check if there are RFID tags in this branch
-    rfids_in_branch = [rfid for rfid, data in st.session_state.rfid_data.items() if data['branch_id'] == branch_id]
+    rfids_in_branch = indexed_keys('rfid_data', 'branch_id', branch_id)
     if rfids_in_branch:
         return False, f"Cannot delete branch with {len(rfids_in_branch)} items. Transfer them first."
     
-    del st.session_state.branches[branch_id]
-    save_data()
+    delete_record('branches', branch_id)
     return True, f"Branch {branch_id} deleted successfully"
 
+@write_operation
 def update_branch(branch_id, name=None, address=None):
-    if branch_id not in st.session_state.branches:
+    if branch_id not in store.branches:
         return False, f"Branch ID {branch_id} not found"
     
-    branch = st.session_state.branches[branch_id]
+    branch = dict(store.branches[branch_id])
     
     if name is not None:
         branch['name'] = name
@@ -444,30 +1804,31 @@ def update_branch(branch_id, name=None, address=None):
     if address is not None:
         branch['address'] = address
     
-    save_data()
+    put_record('branches', branch_id, branch)
     return True, f"Branch {branch_id} updated successfully"
 
 # Transfer Functions
+@write_operation
 def transfer_product(rfid, to_branch_id, timestamp=None):
     if timestamp is None:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        timestamp = now_epoch()
     
-    if rfid not in st.session_state.rfid_data:
+    if rfid not in store.rfid_data:
         return False, f"RFID tag {rfid} not found in inventory"
     
-    if to_branch_id not in st.session_state.branches:
+    if to_branch_id not in store.branches:
         return False, f"Branch {to_branch_id} does not exist"
     
-    from_branch_id = st.session_state.rfid_data[rfid]['branch_id']
+    from_branch_id = store.rfid_data[rfid]['branch_id']
     
     if from_branch_id == to_branch_id:
         return False, f"Item is already in branch {to_branch_id}"
     
-    product_id = st.session_state.rfid_data[rfid]['product_id']
-    product_name = st.session_state.products[product_id]['name'] if product_id in st.session_state.products else "Unknown"
+    product_id = store.rfid_data[rfid]['product_id']
+    product_name = product_name_of(product_id)
     
     # Update the product's branch
-    st.session_state.rfid_data[rfid]['branch_id'] = to_branch_id
+    put_record('rfid_data', rfid, {**store.rfid_data[rfid], 'branch_id': to_branch_id})
     
     # Record the transfer
     transfer_record = {
@@ -479,10 +1840,10 @@ def transfer_product(rfid, to_branch_id, timestamp=None):
         'timestamp': timestamp
     }
     
-    st.session_state.transfers.append(transfer_record)
+    append_record('transfers', transfer_record)
     
     # Add to transactions
-    st.session_state.transactions.append({
+    append_record('transactions', {
         'rfid': rfid,
         'product_id': product_id,
         'from_branch_id': from_branch_id,
@@ -491,20 +1852,160 @@ def transfer_product(rfid, to_branch_id, timestamp=None):
         'timestamp': timestamp
     })
     
-    save_data()
-    return True, f"Product {product_name} with RFID {rfid} transferred from {st.session_state.branches[from_branch_id]['name']} to {st.session_state.branches[to_branch_id]['name']}"
+    return True, f"Product {product_name} with RFID {rfid} transferred from {store.branches[from_branch_id]['name']} to {store.branches[to_branch_id]['name']}"
+
+# Move a list of tags from one branch to another in one batch. Tags are resolved
+# through the branch index, and the branch updates and all transfer and
+# transaction records are committed with a single save. Returns one result row
+# per given RFID like process_sales_excel.
+def transfer_items(rfids, from_branch_id, to_branch_id, timestamp=None):
+    if timestamp is None:
+        timestamp = now_epoch()
+    
+    rfids = pd.Series(rfids, dtype=object).astype(str).str.strip().reset_index(drop=True)
+    duplicate = rfids.duplicated(keep='first')
+    
+    results = pd.DataFrame({
+        'rfid': rfids,
+        'product_name': "Unknown",
+        'status': 'error',
+        'message': f"RFID tag not found in branch {from_branch_id}"
+    })
+    results.loc[duplicate, 'message'] = "RFID tag appears more than once in the selection"
+    
+    if to_branch_id not in store.branches:
+        results['message'] = f"Branch {to_branch_id} does not exist"
+        return results
+    if from_branch_id == to_branch_id:
+        results['message'] = f"Item is already in branch {to_branch_id}"
+        return results
+    
+    # Resolve and move under the write lock so no other session moves the same tags
+    with data_batch():
+        rfid_data = store.rfid_data
+        movable = ~duplicate & rfids.isin(store.indexes[('rfid_data', 'branch_id')].get(from_branch_id, set()))
+        if not movable.any():
+            return results
+        
+        moved_rfids = rfids[movable]
+        items = [rfid_data[rfid] for rfid in moved_rfids]
+        product_ids = pd.Series([item['product_id'] for item in items], index=moved_rfids.index)
+        product_names = product_ids.map(product_name_map(product_ids))
+        
+        transfers = pd.DataFrame({
+            'rfid': moved_rfids,
+            'product_id': product_ids,
+            'product_name': product_names,
+            'from_branch_id': from_branch_id,
+            'to_branch_id': to_branch_id,
+            'timestamp': timestamp
+        })
+        transactions = pd.DataFrame({
+            'rfid': moved_rfids,
+            'product_id': product_ids,
+            'from_branch_id': from_branch_id,
+            'to_branch_id': to_branch_id,
+            'action': 'transferred',
+            'timestamp': timestamp
+        })
+        
+        put_records('rfid_data', {rfid: {**item, 'branch_id': to_branch_id} for rfid, item in zip(moved_rfids, items)})
+        extend_records('transfers', transfers.to_dict('records'))
+        extend_records('transactions', transactions.to_dict('records'))
+    
+    results.loc[movable, 'product_name'] = product_names
+    results.loc[movable, 'status'] = 'transferred'
+    results.loc[movable, 'message'] = ("Product " + product_names + " with RFID " + moved_rfids + " transferred from " +
+                                       store.branches[from_branch_id]['name'] + " to " + store.branches[to_branch_id]['name'])
+    return results
+
+# Stocktake Functions
+# Unique non-empty RFIDs of an uploaded scan chunk that were not read before;
+# used with process_upload(), so handheld exports with repeated reads of the
+# same tag are reduced to a set while they are read
+def read_scanned_rfids(df, seen=None):
+    rfids = df['rfid'].dropna().astype(str).str.strip()
+    rfids = rfids[rfids != ''].drop_duplicates()
+    if seen is not None:
+        rfids = rfids[~rfids.isin(seen)]
+        seen.update(rfids)
+    return rfids
+
+# Compare the tags scanned in a branch with its inventory using set operations
+# against the branch index. Returns the number of tags found in their booked
+# branch and one row per discrepancy with its status: 'missing' (booked to this
+# branch but not scanned), 'unexpected' (booked to another branch) or 'unknown'
+# (not in the inventory).
+def reconcile_stocktake(branch_id, scanned_rfids):
+    scanned = set(scanned_rfids)
+    rfid_data = store.rfid_data
+    branch_rfids = store.indexes[('rfid_data', 'branch_id')].get(branch_id, set())
+    
+    found_count = len(scanned & branch_rfids)
+    missing = branch_rfids - scanned
+    elsewhere = scanned - branch_rfids
+    unexpected = elsewhere & rfid_data.keys()
+    unknown = elsewhere - unexpected
+    
+    rfids = sorted(missing) + sorted(unexpected) + sorted(unknown)
+    items = [rfid_data.get(rfid) for rfid in rfids]
+    product_ids = pd.Series([item['product_id'] if item else None for item in items], dtype=object)
+    discrepancies = pd.DataFrame({
+        'rfid': rfids,
+        'status': ['missing'] * len(missing) + ['unexpected'] * len(unexpected) + ['unknown'] * len(unknown),
+        'product_id': product_ids,
+        'product_name': product_ids.map(product_name_map(product_ids)),
+        'booked_branch_id': [item['branch_id'] if item else None for item in items]
+    })
+    return found_count, discrepancies
+
+# Book the discrepancies of reconcile_stocktake() in one batch: unexpected tags are
+# transferred into the branch and missing tags are removed from the inventory
+# with a 'missing' transaction. Unknown tags have no product yet and are left
+# for the upload tab.
+@write_operation
+def apply_stocktake(branch_id, discrepancies, timestamp=None):
+    if timestamp is None:
+        timestamp = now_epoch()
+    
+    transferred_count = 0
+    unexpected = discrepancies[discrepancies['status'] == 'unexpected']
+    for from_branch_id, group in unexpected.groupby('booked_branch_id'):
+        results = transfer_items(group['rfid'], from_branch_id, branch_id, timestamp)
+        transferred_count += int((results['status'] == 'transferred').sum())
+    
+    # Tags sold or moved since the reconciliation are no longer missing here
+    rfid_data = store.rfid_data
+    missing_rfids = [rfid for rfid in discrepancies.loc[discrepancies['status'] == 'missing', 'rfid']
+                     if rfid in rfid_data and rfid_data[rfid]['branch_id'] == branch_id]
+    extend_records('transactions', [{
+        'rfid': rfid,
+        'product_id': rfid_data[rfid]['product_id'],
+        'branch_id': branch_id,
+        'action': 'missing',
+        'timestamp': timestamp
+    } for rfid in missing_rfids])
+    delete_records('rfid_data', missing_rfids)
+    
+    return True, f"Transferred {transferred_count} unexpected items to {store.branches[branch_id]['name']} and recorded {len(missing_rfids)} missing items"
+
+# Button callback, so the scan is reconciled again after the corrections
+def apply_stocktake_corrections(branch_id, discrepancies):
+    st.session_state.stocktake_result = apply_stocktake(branch_id, discrepancies)
+
 # Sales Functions
+@write_operation
 def process_sale(rfid, sale_price=None, sale_date=None):
     if sale_date is None:
-        sale_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        sale_date = now_epoch()
     
-    if rfid not in st.session_state.rfid_data:
+    if rfid not in store.rfid_data:
         return False, f"RFID tag {rfid} not found in inventory"
     
-    product_id = st.session_state.rfid_data[rfid]['product_id']
-    product_name = st.session_state.products[product_id]['name'] if product_id in st.session_state.products else "Unknown"
-    category = st.session_state.rfid_data[rfid]['category']
-    branch_id = st.session_state.rfid_data[rfid]['branch_id']
+    product_id = store.rfid_data[rfid]['product_id']
+    product_name = product_name_of(product_id)
+    category = store.rfid_data[rfid]['category']
+    branch_id = store.rfid_data[rfid]['branch_id']
     
     # Add to sales record
     sale_record = {
@@ -517,10 +2018,10 @@ def process_sale(rfid, sale_price=None, sale_date=None):
         'sale_price': sale_price
     }
     
-    st.session_state.sales.append(sale_record)
+    append_record('sales', sale_record)
     
     # Add to transactions
-    st.session_state.transactions.append({
+    append_record('transactions', {
         'rfid': rfid,
         'product_id': product_id,
         'branch_id': branch_id,
@@ -529,77 +2030,558 @@ def process_sale(rfid, sale_price=None, sale_date=None):
     })
     
     # Remove from inventory
-    del st.session_state.rfid_data[rfid]
+    delete_record('rfid_data', rfid)
+    
+    return True, f"Product {product_name} with RFID {rfid} marked as sold from {store.branches[branch_id]['name']}"
+
+# Sell every in-stock RFID of an uploaded sales file in one batch. Prices and
+# dates are parsed column-wise, tags are resolved against the inventory in one
+# pass and all sale and transaction records are committed with a single save.
+def process_sales_excel(df, seen=None):
+    missing = df['rfid'].isna()
+    rfids = df['rfid'].astype(str).str.strip()
+    missing |= rfids == ''
+    rfids = rfids.mask(missing, "Missing")
+    
+    # Invalid prices are stored as missing, invalid dates default to now
+    if 'sale_price' in df.columns:
+        prices = pd.to_numeric(df['sale_price'], errors='coerce')
+    else:
+        prices = pd.Series(float('nan'), index=df.index)
+    prices = prices.astype(object).where(prices.notna(), None)
+    
+    now = now_epoch()
+    if 'sale_date' in df.columns:
+        dates = pd.Series(parse_epochs(df['sale_date'], now), index=df.index)
+    else:
+        dates = pd.Series(now, index=df.index)
+    
+    duplicate = ~missing & rfids.duplicated(keep='first')
+    if seen is not None:
+        duplicate |= ~missing & rfids.isin(seen)
+        seen.update(rfids[~missing])
+    
+    results = pd.DataFrame({
+        'rfid': rfids,
+        'product_name': "Unknown",
+        'status': 'error',
+        'message': "RFID tag not found in inventory"
+    }, index=df.index)
+    results.loc[duplicate, 'message'] = "RFID tag appears more than once in the file"
+    results.loc[missing, 'message'] = "Missing RFID tag in row"
+    
+    # Resolve and sell under the write lock so no other session sells the same tags
+    with data_batch():
+        rfid_data = store.rfid_data
+        in_stock = ~missing & ~duplicate & rfids.isin(rfid_data.keys())
+        if not in_stock.any():
+            return results
+        
+        sold_rfids = rfids[in_stock]
+        items = [rfid_data[rfid] for rfid in sold_rfids]
+        product_ids = pd.Series([item['product_id'] for item in items], index=sold_rfids.index)
+        branch_ids = pd.Series([item['branch_id'] for item in items], index=sold_rfids.index)
+        product_names = product_ids.map(product_name_map(product_ids))
+        branch_names = branch_ids.map({
+            branch_id: store.branches[branch_id]['name'] if branch_id in store.branches else "Unknown"
+            for branch_id in branch_ids.unique()
+        })
+        
+        sales = pd.DataFrame({
+            'rfid': sold_rfids,
+            'product_id': product_ids,
+            'product_name': product_names,
+            'category': [item['category'] for item in items],
+            'branch_id': branch_ids,
+            'sale_date': dates[in_stock],
+            'sale_price': prices[in_stock]
+        })
+        transactions = pd.DataFrame({
+            'rfid': sold_rfids,
+            'product_id': product_ids,
+            'branch_id': branch_ids,
+            'action': 'sold',
+            'timestamp': dates[in_stock]
+        })
+        
+        extend_records('sales', sales.to_dict('records'))
+        extend_records('transactions', transactions.to_dict('records'))
+        delete_records('rfid_data', sold_rfids.tolist())
+    
+    results.loc[in_stock, 'product_name'] = product_names
+    results.loc[in_stock, 'status'] = 'sold'
+    results.loc[in_stock, 'message'] = "Product " + product_names + " with RFID " + sold_rfids + " marked as sold from " + branch_names
+    return results
+
+# Scan-to-sell basket
+# The callbacks below run before the page is drawn, so the basket and the
+# message shown with it are already up to date when the sales tab renders.
+def scan_sale_item():
+    rfid = st.session_state.scan_rfid.strip()
+    if not rfid:
+        return
+    
+    basket = st.session_state.sale_basket
+    item = store.rfid_data.get(rfid)
+    if rfid in basket:
+        st.session_state.sale_basket_message = ('warning', f"RFID tag {rfid} is already in the basket")
+    elif item is None:
+        st.session_state.sale_basket_message = ('error', f"RFID tag {rfid} not found in inventory")
+    else:
+        product = store.products.get(item['product_id'])
+        branch = store.branches.get(item['branch_id'])
+        basket[rfid] = {
+            'RFID': rfid,
+            'Product Name': product['name'] if product else "Unknown",
+            'Branch Name': branch['name'] if branch else "Unknown",
+            'Sale Price': st.session_state.scan_sale_price
+        }
+        st.session_state.sale_basket_message = ('success', f"Added {basket[rfid]['Product Name']} (RFID: {rfid})")
+
+# Sell every item of the basket in one batch. Items sold elsewhere since they
+# were scanned are reported and dropped from the basket as well.
+def sell_sale_basket():
+    basket = st.session_state.sale_basket
+    # A local datetime; process_sales_excel takes integer dates as Unix time
+    sale_datetime = datetime.combine(st.session_state.basket_sale_date, st.session_state.basket_sale_time)
+    sales_df = pd.DataFrame({
+        'rfid': list(basket),
+        'sale_price': [line['Sale Price'] for line in basket.values()],
+        'sale_date': sale_datetime
+    })
     
-    save_data()
-    return True, f"Product {product_name} with RFID {rfid} marked as sold from {st.session_state.branches[branch_id]['name']}"
+    try:
+        results = process_sales_excel(sales_df)
+    except Exception as e:
+        st.session_state.sale_basket_message = ('error', f"Error saving data: {str(e)}")
+        return
+    
+    basket.clear()
+    errors = results[results['status'] == 'error']
+    sold_count = len(results) - len(errors)
+    if errors.empty:
+        st.session_state.sale_basket_message = ('success', f"Sold {sold_count} items")
+    else:
+        st.session_state.sale_basket_message = ('warning', f"Sold {sold_count} items. Not sold: " +
+                                                "; ".join(errors['rfid'] + ": " + errors['message']))
+
+def remove_last_basket_item():
+    basket = st.session_state.sale_basket
+    if basket:
+        basket.pop(next(reversed(basket)))
+    st.session_state.sale_basket_message = None
+
+def clear_sale_basket():
+    st.session_state.sale_basket.clear()
+    st.session_state.sale_basket_message = None
+
+# Products whose name or ID contains the search text, at most limit of them,
+# as a DataFrame to look product IDs up in
+def product_matches(search="", limit=PRODUCT_OPTION_LIMIT):
+    with store.lock:
+        product_ids = store.product_search.search(search) if search.strip() else store.products
+        matches = [{'Product ID': product_id, 'Name': store.products[product_id]['name'],
+                    'Category': store.products[product_id]['category']}
+                   for product_id in itertools.islice(product_ids, limit)]
+    return pd.DataFrame(matches, columns=['Product ID', 'Name', 'Category'])
 
-def process_sales_excel(df):
+# IDs of the products matching a search text and category filter, in catalogue
+# order. The category filter is answered by the category index.
+def filter_products(search="", categories=None):
+    with store.lock:
+        product_ids = store.product_search.search(search) if search.strip() else list(store.products)
+        if not categories:
+            return product_ids
+        
+        candidates = set()
+        for category in categories:
+            candidates.update(indexed_keys('products', 'category', category))
+    return [pid for pid in product_ids if pid in candidates]
+
+# Read an uploaded xlsx, csv or parquet file as DataFrames of at most chunk_size
+# rows, each paired with the fraction of the file read so far. Workbooks are
+# read in openpyxl's read-only row mode so memory does not grow with the file.
+def read_upload_chunks(uploaded_file, chunk_size=UPLOAD_CHUNK_ROWS):
+    extension = os.path.splitext(uploaded_file.name)[1].lower()
+    uploaded_file.seek(0)
+    
+    if extension == '.csv':
+        size = max(uploaded_file.size, 1)
+        for chunk in pd.read_csv(uploaded_file, chunksize=chunk_size, dtype={'rfid': str}):
+            yield chunk, min(uploaded_file.tell() / size, 1.0)
+    
+    elif extension == '.parquet':
+        parquet_file = pq.ParquetFile(uploaded_file)
+        total = max(parquet_file.metadata.num_rows, 1)
+        read = 0
+        for batch in parquet_file.iter_batches(batch_size=chunk_size):
+            chunk = batch.to_pandas()
+            chunk.index = pd.RangeIndex(read, read + len(chunk))
+            read += len(chunk)
+            yield chunk, read / total
+        if read == 0:
+            yield parquet_file.schema_arrow.empty_table().to_pandas(), 1.0
+    
+    elif extension == '.xlsx':
+        workbook = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+        try:
+            sheet = workbook.worksheets[0]
+            rows = sheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            columns = [str(name) if name is not None else f"Unnamed: {i}" for i, name in enumerate(header)]
+            total = max((sheet.max_row or 1) - 1, 1)
+            read = 0
+            while True:
+                batch = list(itertools.islice(rows, chunk_size))
+                if not batch and read > 0:
+                    break
+                chunk = pd.DataFrame(batch).reindex(columns=range(len(columns)))
+                chunk.columns = columns
+                chunk.index = pd.RangeIndex(read, read + len(chunk))
+                read += len(chunk)
+                # Blank rows are skipped like pd.read_excel does
+                yield chunk.dropna(how='all'), min(read / total, 1.0)
+                if len(batch) < chunk_size:
+                    break
+        finally:
+            workbook.close()
+    
+    else:
+        # Legacy .xls workbooks have no streaming reader
+        yield pd.read_excel(uploaded_file), 1.0
+
+# Run process(chunk, seen) over every chunk of an uploaded file with a progress
+# bar. Returns the combined results, or None if the file has no 'rfid' column.
+def process_upload(uploaded_file, process):
+    progress = st.progress(0.0, text="Reading file...")
     results = []
-    for _, row in df.iterrows():
+    rows = 0
+    seen = set()
+    try:
+        for chunk, fraction in read_upload_chunks(uploaded_file):
+            if 'rfid' not in chunk.columns:
+                return None
+            results.append(process(chunk, seen))
+            rows += len(chunk)
+            progress.progress(fraction, text=f"Processed {rows:,} rows")
+    finally:
+        progress.empty()
+    
+    if not results:
+        return None
+    return pd.concat(results)
+
+# process_upload() results cached by the SHA-256 of the file bytes, so reruns
+# triggered by other widgets do not read the file again
+def cached_process_upload(uploaded_file, process):
+    cache = st.session_state.upload_cache
+    key = (hashlib.sha256(uploaded_file.getbuffer()).hexdigest(), process.__name__)
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    
+    results = process_upload(uploaded_file, process)
+    cache[key] = results
+    # Evict the least recently used files
+    while len(cache) > UPLOAD_CACHE_SIZE:
+        cache.popitem(last=False)
+    return results
+
+def read_rfid_column(chunk, seen):
+    return chunk[['rfid']]
+
+# process_excel() results for the 'rfid' column of an uploaded file. The file
+# is read once per content; the tags are classified again only when the
+# inventory or the products changed, as other sessions and readers may have
+# added or sold them meanwhile.
+def classify_upload(uploaded_file):
+    rfids = cached_process_upload(uploaded_file, read_rfid_column)
+    if rfids is None:
+        return None
+    
+    version = (store.versions['rfid_data'], store.versions['products'])
+    cached = st.session_state.upload_classification
+    if cached is not None and cached[0] is rfids and cached[1] == version:
+        return cached[2]
+    results = process_excel(rfids)
+    st.session_state.upload_classification = (rfids, version, results)
+    return results
+
+# Reader ingestion
+# RFID readers POST events to http://RFID_INGEST_HOST:RFID_INGEST_PORT/events as a
+# JSON object or list of objects:
+#   {"event": "add", "rfid": ..., "product_id": ..., "branch_id": ...}
+#   {"event": "transfer", "rfid": ..., "branch_id": <destination>}
+#   {"event": "sale", "rfid": ..., "sale_price": ...}
+# with an optional "timestamp" (Unix time or "%Y-%m-%d %H:%M:%S" local time,
+# default time of receipt).
+# Events go on a bounded queue; when it is full the request is answered with
+# 503 and the number of refused events, which the reader sends again later.
+# A writer thread applies the queued events through add_rfid_tag,
+# transfer_product and process_sale and commits them in groups. GET /metrics
+# returns the counters shown in the upload tab.
+# The threads have no Streamlit session, so events must name their branch.
+# Repeated reads of a tag are suppressed by ReadDeduplicator before they are
+# queued, so only state changes reach the store.
+def apply_reader_event(event):
+    rfid = str(event.get('rfid') or '').strip()
+    if not rfid:
+        return False, "Missing RFID tag"
+    kind = event.get('event')
+    branch_id = event.get('branch_id')
+    timestamp = event['timestamp']
+    if not is_unix_time(timestamp) and not isinstance(timestamp, str):
+        return False, f"Invalid timestamp {timestamp}"
+    try:
+        timestamp = unix_to_epoch(timestamp) if is_unix_time(timestamp) else to_epoch(timestamp)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return False, f"Invalid timestamp {timestamp}"
+    
+    if kind == 'add':
+        product_id = event.get('product_id')
+        if product_id not in store.products:
+            return False, f"Product ID {product_id} not found"
+        if branch_id not in store.branches:
+            return False, f"Branch {branch_id} does not exist"
+        return add_rfid_tag(rfid, product_id, store.products[product_id]['category'], branch_id, timestamp)
+    
+    if kind == 'transfer':
+        return transfer_product(rfid, branch_id, timestamp)
+    
+    if kind == 'sale':
+        sale_price = event.get('sale_price')
         try:
-            # Ensure RFID is converted to string and stripped of whitespace
-            if 'rfid' not in row or pd.isna(row['rfid']):
-                results.append({
-                    'rfid': "Missing",
-                    'product_name': "Unknown",
-                    'status': 'error',
-                    'message': "Missing RFID tag in row"
-                })
-                continue
-                
-            rfid = str(row['rfid']).strip()
-            
-            # Check if sale_price column exists and is valid
-            sale_price = None
-            if 'sale_price' in df.columns and not pd.isna(row['sale_price']):
-                try:
-                    sale_price = float(row['sale_price'])
-                except (ValueError, TypeError):
-                    sale_price = None
+            sale_price = float(sale_price) if sale_price is not None else None
+        except (TypeError, ValueError):
+            return False, f"Invalid sale price {sale_price}"
+        return process_sale(rfid, sale_price, timestamp)
+    
+    return False, f"Unknown event type {kind}"
+
+# Sliding read-deduplication window. A read is a repeat if the same event for
+# the same tag came from the same reader (or branch, for readers that send no
+# "reader_id") less than window_ms before; each repeat extends the window, so a
+# tag sitting in a reader's field yields one event. Reads are kept oldest first
+# in an OrderedDict, so expired ones are dropped from the front, and the oldest
+# are evicted beyond capacity.
+class ReadDeduplicator:
+    def __init__(self, window_ms=INGEST_DEDUP_MS, capacity=INGEST_DEDUP_CAPACITY):
+        self.window = window_ms / 1000
+        self.capacity = capacity
+        self.last_seen = OrderedDict()
+        self.lock = threading.Lock()
+        self.suppressed = 0
+        self.evicted = 0
+    
+    def key(self, event):
+        return (event.get('event'), event.get('rfid'), event.get('reader_id', event.get('branch_id')))
+    
+    # True if the event repeats a read inside the window
+    def is_repeat(self, event):
+        if self.window <= 0:
+            return False
+        now = time.monotonic()
+        key = self.key(event)
+        with self.lock:
+            while self.last_seen:
+                oldest_key, seen_at = next(iter(self.last_seen.items()))
+                if now - seen_at < self.window:
+                    break
+                del self.last_seen[oldest_key]
             
-            # Check if sale_date column exists and is valid
-            sale_date = None
-            if 'sale_date' in df.columns and not pd.isna(row['sale_date']):
+            repeat = key in self.last_seen
+            self.last_seen[key] = now
+            self.last_seen.move_to_end(key)
+            if repeat:
+                self.suppressed += 1
+            elif len(self.last_seen) > self.capacity:
+                self.last_seen.popitem(last=False)
+                self.evicted += 1
+            return repeat
+    
+    # Forget a read that could not be queued, so the reader can send it again
+    def forget(self, event):
+        with self.lock:
+            self.last_seen.pop(self.key(event), None)
+
+class IngestRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != '/events':
+            self.send_json(404, {'error': "Not found"})
+            return
+        
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError:
+            self.send_json(400, {'error': "Invalid JSON"})
+            return
+        events = payload if isinstance(payload, list) else [payload]
+        if not all(isinstance(event, dict) for event in events):
+            self.send_json(400, {'error': "Events must be JSON objects"})
+            return
+        
+        # Suppressed repeats count as accepted; the reader must not send them again
+        queued, suppressed = self.server.service.submit(events)
+        accepted = queued + suppressed
+        if accepted < len(events):
+            self.send_json(503, {'accepted': accepted, 'suppressed': suppressed, 'rejected': len(events) - accepted},
+                           {'Retry-After': '1'})
+        else:
+            self.send_json(202, {'accepted': accepted, 'suppressed': suppressed, 'rejected': 0})
+    
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(200, self.server.service.snapshot())
+        else:
+            self.send_json(404, {'error': "Not found"})
+    
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+    
+    # Readers send thousands of requests per second; do not log each one
+    def log_message(self, format, *args):
+        pass
+
+class IngestService:
+    def __init__(self, host, port):
+        self.queue = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+        self.deduplicator = ReadDeduplicator()
+        self.metrics_lock = threading.Lock()
+        self.metrics = {
+            'received': 0,
+            'accepted': 0,
+            'rejected': 0,
+            'applied': 0,
+            'failed': 0,
+            'batches': 0,
+            'commit_ms_total': 0.0,
+            'last_batch_size': 0,
+            'last_commit_ms': 0.0,
+            'queue_high_water': 0,
+            'last_error': None
+        }
+        self.address = f"http://{host}:{port}"
+        self.error = None
+        try:
+            self.server = ThreadingHTTPServer((host, port), IngestRequestHandler)
+        except OSError as e:
+            self.server = None
+            self.error = f"Could not listen on {host}:{port}: {str(e)}"
+            return
+        self.server.daemon_threads = True
+        self.server.service = self
+        threading.Thread(target=self.server.serve_forever, name='rfid-ingest-http', daemon=True).start()
+        threading.Thread(target=self.run_writer, name='rfid-ingest-writer', daemon=True).start()
+    
+    # Queue events until the queue is full, dropping repeated reads; returns the
+    # numbers of queued and suppressed events
+    def submit(self, events):
+        timestamp = time.time()
+        queued = 0
+        suppressed = 0
+        for event in events:
+            if self.deduplicator.is_repeat(event):
+                suppressed += 1
+                continue
+            event.setdefault('timestamp', timestamp)
+            try:
+                self.queue.put_nowait(event)
+            except queue.Full:
+                self.deduplicator.forget(event)
+                break
+            queued += 1
+        
+        with self.metrics_lock:
+            self.metrics['received'] += len(events)
+            self.metrics['accepted'] += queued
+            self.metrics['rejected'] += len(events) - queued - suppressed
+            self.metrics['queue_high_water'] = max(self.metrics['queue_high_water'], self.queue.qsize())
+        return queued, suppressed
+    
+    # Group commit: wait for an event, collect more for up to INGEST_BATCH_MS or
+    # until INGEST_BATCH_SIZE, then apply them all in one data_batch()
+    def run_writer(self):
+        while True:
+            events = [self.queue.get()]
+            deadline = time.monotonic() + INGEST_BATCH_MS / 1000
+            while len(events) < INGEST_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
                 try:
-                    if isinstance(row['sale_date'], str):
-                        sale_date = datetime.strptime(row['sale_date'], "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d %H:%M:%S")
+                    events.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.apply_batch(events)
+    
+    def apply_batch(self, events):
+        started = time.monotonic()
+        applied = 0
+        last_error = None
+        try:
+            with data_batch():
+                for event in events:
+                    # A failed event only undoes its own changes
+                    try:
+                        success, message = apply_reader_event(event)
+                    except Exception as e:
+                        success, message = False, f"{type(e).__name__}: {str(e)}"
+
+                    if success:
+                        applied += 1
                     else:
-                        sale_date = row['sale_date'].strftime("%Y-%m-%d %H:%M:%S")
-                except Exception:
-                    sale_date = None
-            
-            if rfid in st.session_state.rfid_data:
-                product_id = st.session_state.rfid_data[rfid]['product_id']
-                product_name = st.session_state.products[product_id]['name'] if product_id in st.session_state.products else "Unknown"
-                
-                success, message = process_sale(rfid, sale_price, sale_date)
-                
-                results.append({
-                    'rfid': rfid,
-                    'product_name': product_name,
-                    'status': 'sold' if success else 'error',
-                    'message': message
-                })
-            else:
-                results.append({
-                    'rfid': rfid,
-                    'product_name': "Unknown",
-                    'status': 'error',
-                    'message': "RFID tag not found in inventory"
-                })
+                        last_error = f"{event.get('rfid')}: {message}"
         except Exception as e:
-            results.append({
-                'rfid': rfid if 'rfid' in locals() else "Error",
-                'product_name': "Unknown",
-                'status': 'error',
-                'message': str(e)
-            })
+            # The commit failed and the whole batch was rolled back
+            applied = 0
+            last_error = f"Commit of {len(events)} events failed: {str(e)}"
+        commit_ms = (time.monotonic() - started) * 1000
+        
+        with self.metrics_lock:
+            self.metrics['applied'] += applied
+            self.metrics['failed'] += len(events) - applied
+            self.metrics['batches'] += 1
+            self.metrics['commit_ms_total'] += commit_ms
+            self.metrics['last_batch_size'] = len(events)
+            self.metrics['last_commit_ms'] = commit_ms
+            if last_error is not None:
+                self.metrics['last_error'] = last_error
     
-    return results
+    def snapshot(self):
+        with self.metrics_lock:
+            metrics = dict(self.metrics)
+        metrics['queue_depth'] = self.queue.qsize()
+        metrics['queue_capacity'] = INGEST_QUEUE_SIZE
+        metrics['suppressed'] = self.deduplicator.suppressed
+        metrics['dedup_entries'] = len(self.deduplicator.last_seen)
+        metrics['dedup_evicted'] = self.deduplicator.evicted
+        return metrics
+
+# The ingestion service, started once per server process
+@st.cache_resource
+def get_ingest_service():
+    return IngestService(INGEST_HOST, INGEST_PORT)
 
 # Load data at startup
-load_data()
+store = get_data_store()
+refresh_data()
+# Move old history to the archive once a day
+if store.archive_checked != datetime.now().date():
+    archive_history()
+# Accept reader events once the data is loaded
+ingest_service = get_ingest_service() if INGEST_PORT else None
+# Sessions read the shared collections through st.session_state
+for collection in DATA_COLLECTIONS:
+    st.session_state[collection] = store.data[collection]
 
 # Custom CSS
 def load_css():
@@ -712,54 +2694,54 @@ def upload_tab():
     
     with st.expander("Instructions", expanded=False):
         st.info("""
-        1. Upload an Excel file containing RFID tags.
-        2. The Excel file must have a column named 'rfid'.
+        1. Upload an Excel (.xlsx), CSV or Parquet file containing RFID tags.
+        2. The file must have a column named 'rfid'.
         3. The system will check if the tags already exist and show their status.
         4. For new tags, you can assign them to products.
         """)
     
-    uploaded_file = st.file_uploader("Upload Excel file with RFID tags", type=["xlsx", "xls"])
+    uploaded_file = st.file_uploader("Upload file with RFID tags", type=UPLOAD_FILE_TYPES)
     
     if uploaded_file is not None:
         try:
-            df = pd.read_excel(uploaded_file)
+            results = classify_upload(uploaded_file)
             
-            if 'rfid' not in df.columns:
-                st.error("The Excel file must contain a column named 'rfid'")
+            if results is None:
+                st.error("The file must contain a column named 'rfid'")
             else:
-                # Process the uploaded file
-                results = process_excel(df)
-                
                 # Display results
                 st.markdown('<div class="subheader">Results</div>', unsafe_allow_html=True)
                 
                 # Count statuses
-                existing_count = sum(1 for r in results if r['status'] == 'existing')
-                new_count = sum(1 for r in results if r['status'] == 'new')
-                error_count = sum(1 for r in results if r['status'] == 'error')
+                status_counts = results['status'].value_counts()
+                existing_count = int(status_counts.get('existing', 0))
+                new_count = int(status_counts.get('new', 0))
+                duplicate_count = int(status_counts.get('duplicate', 0))
+                error_count = int(status_counts.get('error', 0))
                 
                 # Display summary
-                col1, col2, col3 = st.columns(3)
+                col1, col2, col3, col4 = st.columns(4)
                 col1.metric("Existing Tags", existing_count)
                 col2.metric("New Tags", new_count)
-                col3.metric("Errors", error_count)
+                col3.metric("Duplicates in File", duplicate_count)
+                col4.metric("Errors", error_count)
                 
                 # Display tables by status
                 if existing_count > 0:
                     with st.expander("Existing Tags", expanded=True):
-                        existing_df = pd.DataFrame([r for r in results if r['status'] == 'existing'])
+                        existing_df = results[results['status'] == 'existing']
                         st.dataframe(existing_df)
                 
                 if new_count > 0:
                     with st.expander("New Tags", expanded=True):
-                        new_df = pd.DataFrame([r for r in results if r['status'] == 'new'])
+                        new_df = results[results['status'] == 'new']
                         st.dataframe(new_df)
                         
                         # Let user assign these new tags to products
                         st.markdown('<div class="subheader">Assign Products to New RFID Tags</div>', unsafe_allow_html=True)
                         
                         # Create a product selection for each new tag
-                        new_tags = [r['rfid'] for r in results if r['status'] == 'new']
+                        new_tags = new_df['rfid'].tolist()
                         
                         if not st.session_state.products:
                             st.warning("No products available. Please add products first.")
@@ -779,49 +2761,117 @@ def upload_tab():
                             if st.button("Batch Assign Selected Product to All New RFID Tags"):
                                 if require_permission("add"):
                                     success_count = 0
-                                    for rfid in new_tags:
-                                        success, _ = add_rfid_tag(rfid, selected_product_id, selected_category)
-                                        if success:
-                                            success_count += 1
-                                    
-                                    st.success(f"Successfully assigned product to {success_count} out of {len(new_tags)} RFID tags")
-                                    st.rerun()
+                                    try:
+                                        with data_batch():
+                                            for rfid in new_tags:
+                                                success, _ = add_rfid_tag(rfid, selected_product_id, selected_category)
+                                                if success:
+                                                    success_count += 1
+                                    except Exception as e:
+                                        st.error(f"Batch assignment failed, no tags were assigned: {str(e)}")
+                                    else:
+                                        st.success(f"Successfully assigned product to {success_count} out of {len(new_tags)} RFID tags")
+                                        st.rerun()
                             
-                            # Individual assignment
+                            # Individual assignment through an editable grid
                             st.markdown("---")
                             st.markdown("**Individual Assignment**")
                             
-                            for rfid in new_tags:
-                                st.markdown(f"**RFID: {rfid}**")
-                                col1, col2, col3 = st.columns([2, 1, 1])
-                                
-                                with col1:
-                                    product_id = st.selectbox(f"Product for {rfid}", 
-                                                            options=list(st.session_state.products.keys()),
-                                                            format_func=lambda x: f"{st.session_state.products[x]['name']} (ID: {x})",
-                                                            key=f"product_{rfid}")
-                                
-                                with col2:
-                                    category = st.selectbox(f"Category for {rfid}", 
-                                                          options=st.session_state.categories,
-                                                          key=f"category_{rfid}")
-                                
-                                with col3:
-                                    if st.button("Assign", key=f"assign_{rfid}"):
-                                        if require_permission("add"):
-                                            success, message = add_rfid_tag(rfid, product_id, category)
-                                            if success:
-                                                st.success(message)
-                                            else:
-                                                st.error(message)
+                            # Products are entered by ID and checked on assignment. The grid's
+                            # configuration must not depend on the search, since a change of it
+                            # resets the grid and the products already entered.
+                            product_search = st.text_input("Search Products", key="assignment_product_search",
+                                                           placeholder="Look up product IDs by name or ID")
+                            st.dataframe(product_matches(product_search), hide_index=True, use_container_width=True)
+                            
+                            grid = pd.DataFrame({'rfid': new_tags, 'product_id': None, 'category': None})
+                            edited_grid = st.data_editor(
+                                grid,
+                                key="assignment_grid",
+                                hide_index=True,
+                                disabled=['rfid'],
+                                use_container_width=True,
+                                column_config={
+                                    'rfid': st.column_config.TextColumn("RFID"),
+                                    'product_id': st.column_config.TextColumn("Product ID"),
+                                    'category': st.column_config.SelectboxColumn(
+                                        "Category", options=st.session_state.categories,
+                                        help="Defaults to the category of the product")
+                                }
+                            )
+                            
+                            if st.button("Assign Products to Edited Rows"):
+                                if require_permission("add"):
+                                    product_ids = edited_grid['product_id'].fillna('').astype(str).str.strip()
+                                    assignments = edited_grid.assign(product_id=product_ids)[product_ids != '']
+                                    unknown = sorted(set(assignments['product_id']) - set(store.products))
+                                    if assignments.empty:
+                                        st.warning("Enter a product ID for at least one RFID tag")
+                                    elif unknown:
+                                        st.error(f"Unknown product IDs, no tags were assigned: {', '.join(unknown)}")
+                                    else:
+                                        success_count = 0
+                                        try:
+                                            with data_batch():
+                                                for row in assignments.itertuples():
+                                                    product_id = row.product_id
+                                                    category = row.category
+                                                    if pd.isna(category):
+                                                        category = store.products[product_id]['category']
+                                                    success, _ = add_rfid_tag(row.rfid, product_id, category)
+                                                    if success:
+                                                        success_count += 1
+                                        except Exception as e:
+                                            st.error(f"Assignment failed, no tags were assigned: {str(e)}")
+                                        else:
+                                            st.success(f"Successfully assigned {success_count} out of {len(assignments)} RFID tags")
+                                            del st.session_state["assignment_grid"]
+                                            st.rerun()
+                
+                if duplicate_count > 0:
+                    with st.expander("Duplicates in File", expanded=False):
+                        duplicate_df = results[results['status'] == 'duplicate']
+                        st.dataframe(duplicate_df)
                 
                 if error_count > 0:
                     with st.expander("Errors", expanded=True):
-                        error_df = pd.DataFrame([r for r in results if r['status'] == 'error'])
+                        error_df = results[results['status'] == 'error']
                         st.dataframe(error_df)
         
         except Exception as e:
             st.error(f"Error processing file: {str(e)}")
+    
+    # Events received from RFID readers
+    st.markdown("### Reader Ingestion")
+    
+    if ingest_service is None:
+        st.info("Set RFID_INGEST_PORT to accept events from RFID readers on a local HTTP endpoint")
+    elif ingest_service.error is not None:
+        st.error(ingest_service.error)
+    else:
+        st.markdown(f"Readers post events to `{ingest_service.address}/events`; metrics are at `{ingest_service.address}/metrics`")
+        metrics = ingest_service.snapshot()
+        
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Queue", f"{metrics['queue_depth']:,} / {metrics['queue_capacity']:,}")
+        col2.metric("Queue High Water", f"{metrics['queue_high_water']:,}")
+        col3.metric("Refused (Queue Full)", f"{metrics['rejected']:,}")
+        col4.metric("Received", f"{metrics['received']:,}")
+        
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Repeated Reads Suppressed", f"{metrics['suppressed']:,}")
+        col2.metric("Reads in Dedup Window", f"{metrics['dedup_entries']:,}")
+        col3.metric("Dedup Window", f"{INGEST_DEDUP_MS:,} ms" if INGEST_DEDUP_MS > 0 else "Off")
+        
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Applied", f"{metrics['applied']:,}")
+        col2.metric("Failed", f"{metrics['failed']:,}")
+        col3.metric("Avg Batch Size", f"{(metrics['applied'] + metrics['failed']) / metrics['batches']:.0f}" if metrics['batches'] else "0")
+        col4.metric("Avg Commit", f"{metrics['commit_ms_total'] / metrics['batches']:.0f} ms" if metrics['batches'] else "0 ms")
+        
+        if metrics['last_error']:
+            st.caption(f"Last failed event: {metrics['last_error']}")
+        st.button("Refresh", key="ingest_refresh")
 def product_tab():
     if not require_permission("view"):
         return
@@ -849,15 +2899,8 @@ def product_tab():
                 submit = st.form_submit_button("Add Product")
                 
                 if submit and product_id and name and category:
-                    if image is not None:
-                        try:
-                            image_data = Image.open(image)
-                            success, message = add_product(product_id, name, description, category, image_data)
-                        except Exception as e:
-                            success = False
-                            message = f"Error processing image: {str(e)}"
-                    else:
-                        success, message = add_product(product_id, name, description, category)
+                    image_data = image.getvalue() if image is not None else None
+                    success, message = add_product(product_id, name, description, category, image_data)
                     
                     if success:
                         st.success(message)
@@ -906,7 +2949,24 @@ def product_tab():
                     st.info("No categories to delete")
             else:
                 st.warning("You don't have permission to delete categories")
-    
+
+    # Status of the uploaded images processed in the background
+    if store.image_jobs:
+        running = sum(1 for job in store.image_jobs.values() if job['status'] in ('queued', 'processing'))
+        with st.expander(f"Image Processing ({running} running)", expanded=False):
+            jobs_df = pd.DataFrame([
+                {
+                    'Product ID': job['product_id'],
+                    'Status': job['status'],
+                    'Submitted At': job['submitted_at'],
+                    'Finished At': job['finished_at'],
+                    'Error': job['error']
+                }
+                for job in reversed(list(store.image_jobs.values()))
+            ])
+            st.dataframe(jobs_df, use_container_width=True)
+            st.button("Refresh", key="image_jobs_refresh")
+
     # Display products
     st.markdown("### Products")
     
@@ -922,26 +2982,39 @@ def product_tab():
             filter_category = ["All"]
         
         # Prepare filtered data
-        filtered_products = {}
-        
-        for pid, product in st.session_state.products.items():
-            # Apply search filter
-            if search and search.lower() not in product['name'].lower() and search.lower() not in pid.lower():
-                continue
-            
-            # Apply category filter
-            if "All" not in filter_category and product['category'] not in filter_category:
-                continue
-            
-            filtered_products[pid] = product
+        filtered_ids = filter_products(search, None if "All" in filter_category else filter_category)
         
-        if not filtered_products:
+        if not filtered_ids:
             st.info("No products match the search/filter criteria")
         else:
+            # Start from the first page whenever the search or filter changes
+            product_filter = (search, tuple(filter_category))
+            if st.session_state.product_filter != product_filter:
+                st.session_state.product_filter = product_filter
+                st.session_state.product_page = 1
+            
+            page_count = (len(filtered_ids) - 1) // PRODUCTS_PER_PAGE + 1
+            page = min(st.session_state.product_page, page_count)
+            
+            col1, col2, col3 = st.columns([1, 2, 1])
+            with col1:
+                if st.button("Previous", key="product_page_previous", disabled=page <= 1):
+                    page -= 1
+            with col3:
+                if st.button("Next", key="product_page_next", disabled=page >= page_count):
+                    page += 1
+            with col2:
+                st.markdown(f"Page {page} of {page_count} ({len(filtered_ids)} products)")
+            st.session_state.product_page = page
+            
+            # Only the cards of the current page are built
+            page_ids = filtered_ids[(page - 1) * PRODUCTS_PER_PAGE:page * PRODUCTS_PER_PAGE]
+            
             # Display products in a grid
             cols = st.columns(3)
             
-            for i, (pid, product) in enumerate(filtered_products.items()):
+            for i, pid in enumerate(page_ids):
+                product = st.session_state.products[pid]
                 col_index = i % 3
                 
                 with cols[col_index]:
@@ -951,12 +3024,18 @@ def product_tab():
                         st.markdown(f"Category: {product['category']}")
                         
                         # Display image if available
-                        if product.get('image') and os.path.exists(product['image']):
-                            try:
-                                img = Image.open(product['image'])
-                                st.image(img, width=200)
-                            except Exception as e:
-                                st.error(f"Error loading image: {str(e)}")
+                        try:
+                            thumbnail = product_image_bytes(product, 'thumbnail')
+                            if thumbnail is not None:
+                                st.image(thumbnail, width=200)
+                        except Exception as e:
+                            st.error(f"Error loading image: {str(e)}")
+                        
+                        image_job = pending_image_job(pid)
+                        if image_job is not None and image_job['status'] == 'failed':
+                            st.warning(f"Image processing failed: {image_job['error']}")
+                        elif image_job is not None:
+                            st.caption("Image is being processed...")
                         
                         st.markdown(f"Description: {product['description'] if product['description'] else 'No description'}")
                         
@@ -1003,6 +3082,10 @@ def product_tab():
                         category = None
                         st.warning("No categories available")
                     
+                    preview = product_image_bytes(st.session_state.products[pid], 'preview')
+                    if preview is not None:
+                        st.image(preview, caption="Current image", width=400)
+                    
                     st.markdown("Upload new image (leave empty to keep current image)")
                     image = st.file_uploader("Product Image", type=["jpg", "jpeg", "png"], key="edit_image")
                     
@@ -1017,15 +3100,8 @@ def product_tab():
                         submit = st.form_submit_button("Update Product")
                         
                         if submit:
-                            if image is not None:
-                                try:
-                                    image_data = Image.open(image)
-                                    success, message = update_product(pid, name, description, category, image_data)
-                                except Exception as e:
-                                    success = False
-                                    message = f"Error processing image: {str(e)}"
-                            else:
-                                success, message = update_product(pid, name, description, category)
+                            image_data = image.getvalue() if image is not None else None
+                            success, message = update_product(pid, name, description, category, image_data)
                             
                             if success:
                                 st.success(message)
@@ -1116,48 +3192,21 @@ def inventory_tab():
     # Display inventory for selected branch
     st.markdown(f"### Inventory for {st.session_state.branches[selected_branch]['name']}")
     
-    # Filter inventory by branch
-    branch_inventory = {rfid: data for rfid, data in st.session_state.rfid_data.items() 
-                      if data['branch_id'] == selected_branch}
-    
-    if not branch_inventory:
+    if not store.indexes[('rfid_data', 'branch_id')].get(selected_branch):
         st.info(f"No items in {st.session_state.branches[selected_branch]['name']}")
     else:
-        # Convert to DataFrame for display
-        inventory_data = []
-        for rfid, data in branch_inventory.items():
-            product_id = data['product_id']
-            product_name = st.session_state.products[product_id]['name'] if product_id in st.session_state.products else "Unknown"
-            category = data['category']
-            added_at = data['added_at']
-            
-            inventory_data.append({
-                'RFID': rfid,
-                'Product ID': product_id,
-                'Product Name': product_name,
-                'Category': category,
-                'Added At': added_at
-            })
-        
-        inventory_df = pd.DataFrame(inventory_data)
-        
         # Search and filter
-        search = st.text_input("Search Inventory", placeholder="Enter RFID, product name or ID")
+        search = st.text_input("Search Inventory", placeholder="Enter RFID prefix, product name or ID")
         
         if st.session_state.categories:
-            filter_category = st.multiselect("Filter by Category", options=["All"] + st.session_state.categories, default=["All"])
+            filter_category = st.multiselect("Filter by Category", options=["All"] + st.session_state.categories, default=["All"],
+                                             key="inventory_category_filter")
         else:
             filter_category = ["All"]
         
-        # Apply filters
-        filtered_df = inventory_df.copy()
-        
-        if search:
-            filtered_df = filtered_df[
-                filtered_df['RFID'].str.contains(search, case=False) |
-                filtered_df['Product ID'].str.contains(search, case=False) |
-                filtered_df['Product Name'].str.contains(search, case=False)
-            ]
+        # Apply filters; the search matches RFID prefixes and product IDs or names
+        # through the search indexes
+        filtered_df = store.inventory.frame(selected_branch, search)[['RFID', 'Product ID', 'Product Name', 'Category', 'Added At']]
         
         if "All" not in filter_category:
             filtered_df = filtered_df[filtered_df['Category'].isin(filter_category)]
@@ -1176,18 +3225,18 @@ def inventory_tab():
                 st.metric("Total Items", len(filtered_df))
             
             with col2:
-                categories_count = filtered_df['Category'].value_counts()
+                categories_count = filtered_df['Category'].value_counts().loc[lambda counts: counts > 0]
                 most_common_category = categories_count.index[0] if not categories_count.empty else "None"
-                st.metric("Most Common Category", most_common_category, categories_count[most_common_category] if not categories_count.empty else 0)
+                st.metric("Most Common Category", most_common_category, int(categories_count[most_common_category]) if not categories_count.empty else 0)
             
             with col3:
                 products_count = filtered_df['Product Name'].value_counts()
                 most_common_product = products_count.index[0] if not products_count.empty else "None"
-                st.metric("Most Common Product", most_common_product, products_count[most_common_product] if not products_count.empty else 0)
+                st.metric("Most Common Product", most_common_product, int(products_count[most_common_product]) if not products_count.empty else 0)
             
             # Category distribution
             st.markdown("### Category Distribution")
-            category_counts = filtered_df['Category'].value_counts().reset_index()
+            category_counts = categories_count.reset_index()
             category_counts.columns = ['Category', 'Count']
             
             if not category_counts.empty:
@@ -1219,51 +3268,158 @@ def inventory_tab():
                                                  format_func=lambda x: st.session_state.branches[x]['name'],
                                                  key="dest_branch")
                 
-                # Get items in source branch
-                source_inventory = {rfid: data for rfid, data in st.session_state.rfid_data.items() 
-                                if data['branch_id'] == source_branch}
+                # Select the items by product, category and count, or by an uploaded RFID list
+                selection_mode = st.radio("Select Items By", ["Product / Category", "RFID List"], horizontal=True,
+                                          key="transfer_selection_mode")
                 
-                if not source_inventory:
-                    st.info(f"No items in {st.session_state.branches[source_branch]['name']} to transfer")
-                else:
-                    # Convert to list for selection
-                    source_items = []
-                    for rfid, data in source_inventory.items():
-                        product_id = data['product_id']
-                        product_name = st.session_state.products[product_id]['name'] if product_id in st.session_state.products else "Unknown"
-                        source_items.append((rfid, f"{product_name} (RFID: {rfid})"))
+                selected_rfids = []
+                if selection_mode == "Product / Category":
+                    stocked_product_ids = [product_id for product_id in store.products
+                                          if product_id in store.indexes[('rfid_data', 'product_id')]]
+                    col1, col2, col3 = st.columns(3)
+                    with col1:
+                        transfer_products = st.multiselect("Products", options=stocked_product_ids,
+                                                           format_func=lambda x: f"{store.products[x]['name']} (ID: {x})",
+                                                           key="transfer_products")
+                    with col2:
+                        transfer_categories = st.multiselect("Categories", options=st.session_state.categories,
+                                                             key="transfer_categories")
+                    with col3:
+                        transfer_count = st.number_input("Number of Items (0 = all)", min_value=0, step=1, key="transfer_count")
                     
-                    # Allow selection of items to transfer
-                    selected_rfids = st.multiselect("Select Items to Transfer", 
-                                                options=[i[0] for i in source_items],
-                                                format_func=lambda x: next((i[1] for i in source_items if i[0] == x), x))
+                    # Oldest items are moved first
+                    selected_rfids = store.inventory.select(source_branch, transfer_products, transfer_categories)
+                    if transfer_count:
+                        selected_rfids = selected_rfids[:transfer_count]
+                else:
+                    st.markdown("Upload an Excel, CSV or Parquet file with a column named 'rfid'")
+                    transfer_file = st.file_uploader("Upload RFID list", type=UPLOAD_FILE_TYPES, key="transfer_upload")
+                    if transfer_file is not None:
+                        try:
+                            chunks = [chunk['rfid'].dropna() for chunk, _ in read_upload_chunks(transfer_file)]
+                            selected_rfids = pd.concat(chunks).tolist() if chunks else []
+                        except KeyError:
+                            st.error("The file must contain a column named 'rfid'")
+                        except Exception as e:
+                            st.error(f"Error reading file: {str(e)}")
+                
+                if len(selected_rfids) == 0:
+                    if selection_mode == "Product / Category":
+                        st.info(f"No items in {st.session_state.branches[source_branch]['name']} match the selection")
+                else:
+                    st.markdown(f"**{len(selected_rfids)} items selected**")
                     
-                    if selected_rfids:
-                        if st.button(f"Transfer {len(selected_rfids)} Items to {st.session_state.branches[destination_branch]['name']}"):
-                            results = []
-                            for rfid in selected_rfids:
-                                success, message = transfer_product(rfid, destination_branch)
-                                results.append((rfid, success, message))
-                            
-                            # Show results
-                            success_count = sum(1 for _, success, _ in results if success)
+                    if st.button(f"Transfer {len(selected_rfids)} Items to {st.session_state.branches[destination_branch]['name']}"):
+                        try:
+                            results = transfer_items(selected_rfids, source_branch, destination_branch)
+                        except Exception as e:
+                            results = None
+                            st.error(f"Transfer rolled back: {str(e)}")
+                        
+                        # Show results
+                        if results is not None:
+                            errors = results[results['status'] == 'error']
+                            success_count = len(results) - len(errors)
                             if success_count > 0:
                                 st.success(f"Successfully transferred {success_count} out of {len(results)} items")
-                                
-                                # Show failures if any
-                                failures = [(rfid, message) for rfid, success, message in results if not success]
-                                if failures:
-                                    st.error(f"Failed to transfer {len(failures)} items")
-                                    for rfid, message in failures:
-                                        st.error(f"RFID {rfid}: {message}")
-                                
-                                st.rerun()
                             else:
                                 st.error("Failed to transfer any items")
-                                for rfid, _, message in results:
-                                    st.error(f"RFID {rfid}: {message}")
+                            
+                            if not errors.empty:
+                                st.error(f"Failed to transfer {len(errors)} items")
+                                st.dataframe(errors, use_container_width=True)
             else:
                 st.warning("You don't have permission to transfer items")
+    
+    # Compare a scan of a whole branch with its inventory
+    st.markdown("### Stocktake")
+    
+    with st.expander("Reconcile a Branch Scan", expanded=False):
+        stocktake_branch = st.selectbox("Scanned Branch",
+                                        options=branches,
+                                        format_func=lambda x: st.session_state.branches[x]['name'],
+                                        key="stocktake_branch")
+        
+        st.markdown("Upload an Excel, CSV or Parquet file with the scanned tags in a column named 'rfid'. Repeated reads of a tag are counted once.")
+        scan_file = st.file_uploader("Upload scan", type=UPLOAD_FILE_TYPES, key="stocktake_upload")
+        
+        if scan_file is not None:
+            try:
+                scanned_rfids = cached_process_upload(scan_file, read_scanned_rfids)
+            except Exception as e:
+                scanned_rfids = None
+                st.error(f"Error processing file: {str(e)}")
+            
+            # Outcome of the corrections applied by the last click, shown once
+            stocktake_result = st.session_state.pop('stocktake_result', None)
+            if stocktake_result is not None:
+                success, message = stocktake_result
+                if success:
+                    st.success(message)
+                else:
+                    st.error(message)
+            
+            if scanned_rfids is None:
+                st.error("The file must contain a column named 'rfid'")
+            else:
+                found_count, discrepancies = reconcile_stocktake(stocktake_branch, scanned_rfids)
+                status_counts = discrepancies['status'].value_counts()
+                
+                col1, col2, col3, col4 = st.columns(4)
+                col1.metric("Found", found_count)
+                col2.metric("Missing", int(status_counts.get('missing', 0)))
+                col3.metric("Unexpected", int(status_counts.get('unexpected', 0)))
+                col4.metric("Unknown", int(status_counts.get('unknown', 0)))
+                
+                if discrepancies.empty:
+                    st.success("The scan matches the inventory")
+                else:
+                    st.dataframe(discrepancies, use_container_width=True)
+                    
+                    if status_counts.get('unknown', 0) > 0:
+                        st.info("Unknown tags are not in the inventory. Upload them in the Upload tab to assign products.")
+                    
+                    if status_counts.get('missing', 0) + status_counts.get('unexpected', 0) > 0:
+                        if not has_permission("edit"):
+                            st.warning("You don't have permission to apply stocktake corrections")
+                        else:
+                            st.button("Apply Corrections", key="apply_stocktake", on_click=apply_stocktake_corrections,
+                                      args=(stocktake_branch, discrepancies))
+# Raw records of a history collection between two dates (inclusive), read only
+# once the user ticks the checkbox and shown a page at a time. The records are
+# kept in the session until the range, the filters or the collection change.
+def show_raw_history(label, key, collection, start_date, end_date, filters=None, columns=None):
+    if not st.checkbox(label, key=key):
+        return
+    
+    query = (collection, start_date, end_date, tuple((field, tuple(values)) for field, values in sorted((filters or {}).items())),
+             store.versions[collection], tuple(store.archive_runs))
+    cached = st.session_state.get(f"{key}_records")
+    if cached is None or cached[0] != query:
+        cached = (query, query_history(collection, start_date, end_date, filters))
+        st.session_state[f"{key}_records"] = cached
+        st.session_state[f"{key}_page"] = 1
+    records = cached[1]
+    if records.empty:
+        st.info("No records in the selected range")
+        return
+    
+    page_count = (len(records) - 1) // HISTORY_ROWS_PER_PAGE + 1
+    page = min(st.session_state[f"{key}_page"], page_count)
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if st.button("Previous", key=f"{key}_previous", disabled=page <= 1):
+            page -= 1
+    with col3:
+        if st.button("Next", key=f"{key}_next", disabled=page >= page_count):
+            page += 1
+    with col2:
+        st.markdown(f"Page {page} of {page_count} ({len(records)} records)")
+    st.session_state[f"{key}_page"] = page
+    
+    page_records = records.iloc[(page - 1) * HISTORY_ROWS_PER_PAGE:page * HISTORY_ROWS_PER_PAGE]
+    st.dataframe(page_records[columns] if columns else page_records, use_container_width=True)
+
 def sales_tab():
     if not require_permission("view"):
         return
@@ -1273,88 +3429,88 @@ def sales_tab():
     # Process sales
     with st.expander("Process Sales", expanded=False):
         if has_permission("edit"):
-            st.markdown("### Single Item Sale")
+            st.markdown("### Scan to Sell")
             
             col1, col2 = st.columns(2)
             
             with col1:
-                # Select item from inventory
-                inventory_items = []
-                for rfid, data in st.session_state.rfid_data.items():
-                    product_id = data['product_id']
-                    product_name = st.session_state.products[product_id]['name'] if product_id in st.session_state.products else "Unknown"
-                    branch_name = st.session_state.branches[data['branch_id']]['name']
-                    inventory_items.append((rfid, f"{product_name} - {branch_name} (RFID: {rfid})"))
-                
-                if not inventory_items:
-                    st.info("No items in inventory")
-                    selected_rfid = None
-                else:
-                    selected_rfid = st.selectbox("Select Item to Sell", 
-                                              options=[i[0] for i in inventory_items],
-                                              format_func=lambda x: next((i[1] for i in inventory_items if i[0] == x), x))
+                # Each scan resolves the tag with a dictionary lookup and adds it to the basket
+                with st.form("scan_sale_form", clear_on_submit=True):
+                    st.text_input("Scan RFID", key="scan_rfid", placeholder="Scan or type an RFID tag and press Enter")
+                    st.form_submit_button("Add to Basket", on_click=scan_sale_item)
             
             with col2:
-                sale_price = st.number_input("Sale Price", min_value=0.0, step=0.01)
-                sale_date = st.date_input("Sale Date")
-                sale_time = st.time_input("Sale Time")
+                st.number_input("Sale Price", min_value=0.0, step=0.01, key="scan_sale_price")
+                st.date_input("Sale Date", key="basket_sale_date")
+                st.time_input("Sale Time", key="basket_sale_time")
             
-            if selected_rfid and st.button("Process Sale"):
-                # Combine date and time
-                sale_datetime = datetime.combine(sale_date, sale_time).strftime("%Y-%m-%d %H:%M:%S")
-                
-                success, message = process_sale(selected_rfid, sale_price, sale_datetime)
-                if success:
+            if st.session_state.sale_basket_message is not None:
+                kind, message = st.session_state.sale_basket_message
+                if kind == 'success':
                     st.success(message)
-                    st.rerun()
+                elif kind == 'warning':
+                    st.warning(message)
                 else:
                     st.error(message)
             
+            basket = st.session_state.sale_basket
+            if not basket:
+                st.info("Scan items to add them to the basket")
+            else:
+                basket_df = pd.DataFrame(list(basket.values()))
+                st.dataframe(basket_df, use_container_width=True)
+                
+                col1, col2 = st.columns(2)
+                col1.metric("Items", len(basket))
+                col2.metric("Total", f"{basket_df['Sale Price'].sum():.2f}")
+                
+                col1, col2, col3 = st.columns(3)
+                col1.button("Sell Basket", on_click=sell_sale_basket)
+                col2.button("Remove Last Item", on_click=remove_last_basket_item)
+                col3.button("Clear Basket", on_click=clear_sale_basket)
+            
             st.markdown("### Batch Sales Processing")
-            st.markdown("Upload an Excel file with sales data")
+            st.markdown("Upload an Excel, CSV or Parquet file with sales data")
             
-            with st.expander("Instructions", expanded=False):
-                st.info("""
-                1. Upload an Excel file containing sales data.
-                2. The Excel file must have a column named 'rfid'.
-                3. Optional columns: 'sale_price' and 'sale_date'.
-                4. The system will process each sale and remove items from inventory.
-                """)
+            st.info("""
+            1. Upload an Excel (.xlsx), CSV or Parquet file containing sales data.
+            2. The file must have a column named 'rfid'.
+            3. Optional columns: 'sale_price' and 'sale_date'.
+            4. The system will process each sale and remove items from inventory.
+            """)
             
-            uploaded_file = st.file_uploader("Upload Excel file with sales data", type=["xlsx", "xls"], key="sales_upload")
+            uploaded_file = st.file_uploader("Upload file with sales data", type=UPLOAD_FILE_TYPES, key="sales_upload")
             
             if uploaded_file is not None:
                 try:
-                    df = pd.read_excel(uploaded_file)
+                    # Process the uploaded file, committing one batch per chunk. The
+                    # cache also keeps reruns from selling the same file again.
+                    results = cached_process_upload(uploaded_file, process_sales_excel)
                     
-                    if 'rfid' not in df.columns:
-                        st.error("The Excel file must contain a column named 'rfid'")
+                    if results is None:
+                        st.error("The file must contain a column named 'rfid'")
                     else:
-                        # Process the uploaded file
-                        results = process_sales_excel(df)
-                        
                         # Display results
                         st.markdown('<div class="subheader">Sales Results</div>', unsafe_allow_html=True)
                         
                         # Count statuses
-                        sold_count = sum(1 for r in results if r['status'] == 'sold')
-                        error_count = sum(1 for r in results if r['status'] == 'error')
+                        status_counts = results['status'].value_counts()
+                        sold_count = int(status_counts.get('sold', 0))
+                        error_count = int(status_counts.get('error', 0))
                         
                         # Display summary
                         col1, col2 = st.columns(2)
                         col1.metric("Successfully Sold", sold_count)
                         col2.metric("Errors", error_count)
                         
-                        # Display tables by status
+                        # Display tables by status (expanders cannot be nested in this expander)
                         if sold_count > 0:
-                            with st.expander("Sold Items", expanded=True):
-                                sold_df = pd.DataFrame([r for r in results if r['status'] == 'sold'])
-                                st.dataframe(sold_df)
+                            st.markdown("**Sold Items**")
+                            st.dataframe(results[results['status'] == 'sold'])
                         
                         if error_count > 0:
-                            with st.expander("Errors", expanded=True):
-                                error_df = pd.DataFrame([r for r in results if r['status'] == 'error'])
-                                st.dataframe(error_df)
+                            st.markdown("**Errors**")
+                            st.dataframe(results[results['status'] == 'error'])
                 
                 except Exception as e:
                     st.error(f"Error processing file: {str(e)}")
@@ -1364,18 +3520,14 @@ def sales_tab():
     # Sales history
     st.markdown("### Sales History")
     
-    if not st.session_state.sales:
+    if not store.rollups['sales']:
         st.info("No sales recorded yet")
     else:
-        # Convert to DataFrame for display
-        sales_data = pd.DataFrame(st.session_state.sales)
-        
         # Date range filter
         col1, col2 = st.columns(2)
         
         with col1:
-            min_date = datetime.strptime(min(sales_data['sale_date']), "%Y-%m-%d %H:%M:%S").date() if not sales_data.empty else datetime.now().date()
-            max_date = datetime.strptime(max(sales_data['sale_date']), "%Y-%m-%d %H:%M:%S").date() if not sales_data.empty else datetime.now().date()
+            min_date, max_date = history_date_range('sales') or (datetime.now().date(), datetime.now().date())
             start_date = st.date_input("From Date", min_date)
         
         with col2:
@@ -1392,62 +3544,52 @@ def sales_tab():
         if st.session_state.categories:
             selected_categories = st.multiselect("Filter by Category", 
                                               options=["All"] + st.session_state.categories,
-                                              default=["All"])
+                                              default=["All"],
+                                              key="sales_category_filter")
         else:
             selected_categories = ["All"]
         
         # Apply filters
-        filtered_sales = sales_data.copy()
-        
-        # Date filter
-        filtered_sales = filtered_sales[
-            (pd.to_datetime(filtered_sales['sale_date']).dt.date >= start_date) &
-            (pd.to_datetime(filtered_sales['sale_date']).dt.date <= end_date)
-        ]
-        
-        # Branch filter
+        filters = {}
         if "All" not in selected_branches:
-            filtered_sales = filtered_sales[filtered_sales['branch_id'].isin(selected_branches)]
-        
-        # Category filter
+            filters['branch_id'] = selected_branches
         if "All" not in selected_categories:
-            filtered_sales = filtered_sales[filtered_sales['category'].isin(selected_categories)]
+            filters['category'] = selected_categories
         
-        # Display filtered sales
-        if filtered_sales.empty:
+        # Metrics and charts are computed from the daily rollup; the raw
+        # sales are only read when asked for
+        sales_rollup = rollup_frame('sales', start_date, end_date, filters)
+        
+        if sales_rollup.empty:
             st.info("No sales match the filter criteria")
         else:
-            st.dataframe(filtered_sales, use_container_width=True)
+            show_raw_history("Show Sales Records", "raw_sales_history", 'sales', start_date, end_date, filters)
             
             # Summary metrics
             st.markdown("### Sales Summary")
             col1, col2, col3 = st.columns(3)
             
             with col1:
-                st.metric("Total Sales", len(filtered_sales))
+                st.metric("Total Sales", int(sales_rollup['count'].sum()))
             
             with col2:
-                # Calculate total revenue if sale_price column has values
-                if 'sale_price' in filtered_sales.columns and filtered_sales['sale_price'].notna().any():
-                    total_revenue = filtered_sales['sale_price'].sum()
+                # Calculate total revenue if any sale has a price
+                if sales_rollup['priced'].sum() > 0:
+                    total_revenue = sales_rollup['revenue'].sum()
                     st.metric("Total Revenue", f"${total_revenue:.2f}")
                 else:
                     st.metric("Total Revenue", "N/A")
             
             with col3:
-                categories_count = filtered_sales['category'].value_counts()
+                categories_count = sales_rollup.groupby('category')['count'].sum().sort_values(ascending=False)
                 most_common_category = categories_count.index[0] if not categories_count.empty else "None"
-                st.metric("Top Category", most_common_category, categories_count[most_common_category] if not categories_count.empty else 0)
+                st.metric("Top Category", most_common_category, int(categories_count[most_common_category]) if not categories_count.empty else 0)
             
             # Sales trends
             st.markdown("### Sales Trends")
             
-            # Add date column for easier grouping
-            filtered_sales['date'] = pd.to_datetime(filtered_sales['sale_date']).dt.date
-            
             # Group by date
-            daily_sales = filtered_sales.groupby('date').size().reset_index(name='count')
-            daily_sales['date'] = pd.to_datetime(daily_sales['date'])
+            daily_sales = sales_rollup.groupby('date')['count'].sum().reset_index()
             
             # Line chart for sales over time
             fig = px.line(daily_sales, x='date', y='count', title='Daily Sales')
@@ -1455,7 +3597,7 @@ def sales_tab():
             
             # Category distribution
             st.markdown("### Category Distribution")
-            category_counts = filtered_sales['category'].value_counts().reset_index()
+            category_counts = categories_count.reset_index()
             category_counts.columns = ['Category', 'Count']
             
             if not category_counts.empty:
@@ -1464,9 +3606,10 @@ def sales_tab():
             
             # Branch distribution
             st.markdown("### Branch Distribution")
-            branch_counts = filtered_sales['branch_id'].value_counts().reset_index()
+            branch_counts = sales_rollup.groupby('branch_id')['count'].sum().sort_values(ascending=False).reset_index()
             branch_counts.columns = ['Branch', 'Count']
-            branch_counts['Branch Name'] = branch_counts['Branch'].apply(lambda x: st.session_state.branches[x]['name'])
+            branch_counts['Branch Name'] = branch_counts['Branch'].apply(
+                lambda x: st.session_state.branches[x]['name'] if x in st.session_state.branches else "Unknown")
             
             if not branch_counts.empty:
                 fig = px.bar(branch_counts, x='Branch Name', y='Count', title='Sales by Branch')
@@ -1490,27 +3633,7 @@ def reports_tab():
             st.info("No inventory data available")
             return
         
-        # Convert to DataFrame for analysis
-        inventory_data = []
-        for rfid, data in st.session_state.rfid_data.items():
-            product_id = data['product_id']
-            product_name = st.session_state.products[product_id]['name'] if product_id in st.session_state.products else "Unknown"
-            category = data['category']
-            branch_id = data['branch_id']
-            branch_name = st.session_state.branches[branch_id]['name'] if branch_id in st.session_state.branches else "Unknown"
-            added_at = data['added_at']
-            
-            inventory_data.append({
-                'RFID': rfid,
-                'Product ID': product_id,
-                'Product Name': product_name,
-                'Category': category,
-                'Branch ID': branch_id,
-                'Branch Name': branch_name,
-                'Added At': added_at
-            })
-        
-        inventory_df = pd.DataFrame(inventory_data)
+        inventory_df = store.inventory.frame()
         
         # Summary metrics
         st.markdown("#### Overall Metrics")
@@ -1566,59 +3689,51 @@ def reports_tab():
     elif report_type == "Sales Analysis":
         st.markdown("### Sales Analysis Report")
         
-        if not st.session_state.sales:
+        if not store.rollups['sales']:
             st.info("No sales data available")
             return
         
-        # Convert to DataFrame for analysis
-        sales_df = pd.DataFrame(st.session_state.sales)
-        
-        # Add datetime column
-        sales_df['datetime'] = pd.to_datetime(sales_df['sale_date'])
-        sales_df['date'] = sales_df['datetime'].dt.date
+        min_date, max_date = history_date_range('sales') or (datetime.now().date(), datetime.now().date())
         
         # Date range filter
         col1, col2 = st.columns(2)
         
         with col1:
-            min_date = sales_df['date'].min() if not sales_df.empty else datetime.now().date()
             start_date = st.date_input("From Date", min_date, key="sales_start_date")
         
         with col2:
-            max_date = sales_df['date'].max() if not sales_df.empty else datetime.now().date()
             end_date = st.date_input("To Date", max_date, key="sales_end_date")
         
-        # Apply date filter
-        filtered_sales = sales_df[
-            (sales_df['date'] >= start_date) &
-            (sales_df['date'] <= end_date)
-        ]
+        # Apply date filter to the daily rollup
+        sales_rollup = rollup_frame('sales', start_date, end_date)
+        if sales_rollup.empty:
+            st.info("No sales in the selected date range")
+            return
         
         # Summary metrics
         st.markdown("#### Sales Metrics")
         col1, col2, col3, col4 = st.columns(4)
         
         with col1:
-            st.metric("Total Sales", len(filtered_sales))
+            st.metric("Total Sales", int(sales_rollup['count'].sum()))
         
         with col2:
-            if 'sale_price' in filtered_sales.columns and filtered_sales['sale_price'].notna().any():
-                total_revenue = filtered_sales['sale_price'].sum()
+            if sales_rollup['priced'].sum() > 0:
+                total_revenue = sales_rollup['revenue'].sum()
                 st.metric("Total Revenue", f"${total_revenue:.2f}")
             else:
                 st.metric("Total Revenue", "N/A")
         
         with col3:
-            unique_products = filtered_sales['product_id'].nunique()
-            st.metric("Products Sold", unique_products)
+            st.metric("Products Sold", rollup_product_count('sales', start_date, end_date))
         
         with col4:
-            unique_categories = filtered_sales['category'].nunique()
+            unique_categories = sales_rollup['category'].nunique()
             st.metric("Categories Sold", unique_categories)
         
         # Sales over time
         st.markdown("#### Sales Trend")
-        daily_sales = filtered_sales.groupby('date').size().reset_index(name='count')
+        daily_sales = sales_rollup.groupby('date')['count'].sum().reset_index()
         
         if not daily_sales.empty:
             fig = px.line(daily_sales, x='date', y='count', title='Daily Sales')
@@ -1626,7 +3741,7 @@ def reports_tab():
         
         # Category breakdown
         st.markdown("#### Category Sales")
-        category_counts = filtered_sales['category'].value_counts().reset_index()
+        category_counts = sales_rollup.groupby('category')['count'].sum().sort_values(ascending=False).reset_index()
         category_counts.columns = ['Category', 'Count']
         
         if not category_counts.empty:
@@ -1635,7 +3750,7 @@ def reports_tab():
         
         # Branch breakdown
         st.markdown("#### Branch Sales")
-        branch_counts = filtered_sales['branch_id'].value_counts().reset_index()
+        branch_counts = sales_rollup.groupby('branch_id')['count'].sum().sort_values(ascending=False).reset_index()
         branch_counts.columns = ['Branch', 'Count']
         
         # Add branch names
@@ -1647,66 +3762,55 @@ def reports_tab():
             st.plotly_chart(fig, use_container_width=True)
         
         # Raw data table
-        with st.expander("View Raw Sales Data"):
-            st.dataframe(filtered_sales, use_container_width=True)
+        show_raw_history("View Raw Sales Data", "raw_sales_report", 'sales', start_date, end_date)
     
     elif report_type == "Transaction History":
         st.markdown("### Transaction History Report")
         
-        if not st.session_state.transactions:
+        if not store.rollups['transactions']:
             st.info("No transaction data available")
             return
         
-        # Convert to DataFrame for analysis
-        transactions_df = pd.DataFrame(st.session_state.transactions)
-        
-        # Add datetime column
-        transactions_df['datetime'] = pd.to_datetime(transactions_df['timestamp'])
-        transactions_df['date'] = transactions_df['datetime'].dt.date
+        min_date, max_date = history_date_range('transactions') or (datetime.now().date(), datetime.now().date())
         
         # Date range filter
         col1, col2 = st.columns(2)
         
         with col1:
-            min_date = transactions_df['date'].min() if not transactions_df.empty else datetime.now().date()
             start_date = st.date_input("From Date", min_date, key="trans_start_date")
         
         with col2:
-            max_date = transactions_df['date'].max() if not transactions_df.empty else datetime.now().date()
             end_date = st.date_input("To Date", max_date, key="trans_end_date")
         
         # Action type filter
-        actions = transactions_df['action'].unique().tolist()
+        actions = ['added', 'transferred', 'sold', 'missing']
         selected_actions = st.multiselect("Filter by Action Type", options=["All"] + actions, default=["All"])
         
-        # Apply filters
-        filtered_trans = transactions_df[
-            (transactions_df['date'] >= start_date) &
-            (transactions_df['date'] <= end_date)
-        ]
-        
-        if "All" not in selected_actions:
-            filtered_trans = filtered_trans[filtered_trans['action'].isin(selected_actions)]
+        # Apply filters to the daily rollup
+        filters = {} if "All" in selected_actions else {'action': selected_actions}
+        trans_rollup = rollup_frame('transactions', start_date, end_date, filters)
+        if trans_rollup.empty:
+            st.info("No transactions match the filter criteria")
+            return
         
         # Summary metrics
         st.markdown("#### Transaction Metrics")
         col1, col2, col3 = st.columns(3)
         
         with col1:
-            st.metric("Total Transactions", len(filtered_trans))
+            st.metric("Total Transactions", int(trans_rollup['count'].sum()))
         
         with col2:
-            action_counts = filtered_trans['action'].value_counts()
+            action_counts = trans_rollup.groupby('action')['count'].sum().sort_values(ascending=False)
             most_common_action = action_counts.index[0] if not action_counts.empty else "None"
-            st.metric("Most Common Action", most_common_action, action_counts[most_common_action] if not action_counts.empty else 0)
+            st.metric("Most Common Action", most_common_action, int(action_counts[most_common_action]) if not action_counts.empty else 0)
         
         with col3:
-            unique_products = filtered_trans['product_id'].nunique()
-            st.metric("Unique Products", unique_products)
+            st.metric("Unique Products", rollup_product_count('transactions', start_date, end_date, filters))
         
         # Transactions over time
         st.markdown("#### Transaction Trend")
-        daily_trans = filtered_trans.groupby('date').size().reset_index(name='count')
+        daily_trans = trans_rollup.groupby('date')['count'].sum().reset_index()
         
         if not daily_trans.empty:
             fig = px.line(daily_trans, x='date', y='count', title='Daily Transactions')
@@ -1714,7 +3818,7 @@ def reports_tab():
         
         # Action type breakdown
         st.markdown("#### Action Type Breakdown")
-        action_counts = filtered_trans['action'].value_counts().reset_index()
+        action_counts = action_counts.reset_index()
         action_counts.columns = ['Action', 'Count']
         
         if not action_counts.empty:
@@ -1722,32 +3826,24 @@ def reports_tab():
             st.plotly_chart(fig, use_container_width=True)
         
         # Raw data table
-        with st.expander("View Raw Transaction Data"):
-            st.dataframe(filtered_trans, use_container_width=True)
+        show_raw_history("View Raw Transaction Data", "raw_transactions_report", 'transactions', start_date, end_date, filters)
     
     elif report_type == "Transfer History":
         st.markdown("### Transfer History Report")
         
-        if not st.session_state.transfers:
+        if not store.rollups['transfers']:
             st.info("No transfer data available")
             return
         
-        # Convert to DataFrame for analysis
-        transfers_df = pd.DataFrame(st.session_state.transfers)
-        
-        # Add datetime column
-        transfers_df['datetime'] = pd.to_datetime(transfers_df['timestamp'])
-        transfers_df['date'] = transfers_df['datetime'].dt.date
+        min_date, max_date = history_date_range('transfers') or (datetime.now().date(), datetime.now().date())
         
         # Date range filter
         col1, col2 = st.columns(2)
         
         with col1:
-            min_date = transfers_df['date'].min() if not transfers_df.empty else datetime.now().date()
             start_date = st.date_input("From Date", min_date, key="transfer_start_date")
         
         with col2:
-            max_date = transfers_df['date'].max() if not transfers_df.empty else datetime.now().date()
             end_date = st.date_input("To Date", max_date, key="transfer_end_date")
         
         # Branch filter
@@ -1763,35 +3859,34 @@ def reports_tab():
                                   default=["All"])
         
         # Apply filters
-        filtered_transfers = transfers_df[
-            (transfers_df['date'] >= start_date) &
-            (transfers_df['date'] <= end_date)
-        ]
-        
+        filters = {}
         if "All" not in from_branches:
-            filtered_transfers = filtered_transfers[filtered_transfers['from_branch_id'].isin(from_branches)]
-        
+            filters['from_branch_id'] = from_branches
         if "All" not in to_branches:
-            filtered_transfers = filtered_transfers[filtered_transfers['to_branch_id'].isin(to_branches)]
+            filters['to_branch_id'] = to_branches
+        
+        transfer_rollup = rollup_frame('transfers', start_date, end_date, filters)
+        if transfer_rollup.empty:
+            st.info("No transfers match the filter criteria")
+            return
         
         # Summary metrics
         st.markdown("#### Transfer Metrics")
         col1, col2, col3 = st.columns(3)
         
         with col1:
-            st.metric("Total Transfers", len(filtered_transfers))
+            st.metric("Total Transfers", int(transfer_rollup['count'].sum()))
         
         with col2:
-            unique_products = filtered_transfers['product_id'].nunique()
-            st.metric("Products Transferred", unique_products)
+            st.metric("Products Transferred", rollup_product_count('transfers', start_date, end_date, filters))
         
         with col3:
-            unique_branches_involved = set(filtered_transfers['from_branch_id'].tolist() + filtered_transfers['to_branch_id'].tolist())
+            unique_branches_involved = set(transfer_rollup['from_branch_id']) | set(transfer_rollup['to_branch_id'])
             st.metric("Branches Involved", len(unique_branches_involved))
         
         # Transfers over time
         st.markdown("#### Transfer Trend")
-        daily_transfers = filtered_transfers.groupby('date').size().reset_index(name='count')
+        daily_transfers = transfer_rollup.groupby('date')['count'].sum().reset_index()
         
         if not daily_transfers.empty:
             fig = px.line(daily_transfers, x='date', y='count', title='Daily Transfers')
@@ -1799,7 +3894,7 @@ def reports_tab():
         
         # Branch flow analysis
         st.markdown("#### Branch Transfer Flow")
-        branch_flow = filtered_transfers.groupby(['from_branch_id', 'to_branch_id']).size().reset_index(name='count')
+        branch_flow = transfer_rollup.groupby(['from_branch_id', 'to_branch_id'])['count'].sum().reset_index()
         
         # Add branch names
         branch_flow['From Branch'] = branch_flow['from_branch_id'].apply(
@@ -1813,9 +3908,8 @@ def reports_tab():
             st.plotly_chart(fig, use_container_width=True)
         
         # Raw data table
-        with st.expander("View Raw Transfer Data"):
-            display_cols = ['rfid', 'product_id', 'product_name', 'from_branch_id', 'to_branch_id', 'timestamp']
-            st.dataframe(filtered_transfers[display_cols], use_container_width=True)
+        display_cols = ['rfid', 'product_id', 'product_name', 'from_branch_id', 'to_branch_id', 'timestamp']
+        show_raw_history("View Raw Transfer Data", "raw_transfers_report", 'transfers', start_date, end_date, filters, display_cols)
 
 def users_tab():
     if not has_permission("manage_users"):
@@ -1870,7 +3964,7 @@ def users_tab():
                 'Role': user_data.get('role', 'user'),
                 'Active': user_data.get('active', True),
                 'Permissions': ", ".join(user_data.get('permissions', [])),
-                'Created': user_data.get('created_at', 'Unknown')
+                'Created': format_epoch(user_data['created_at']) if 'created_at' in user_data else 'Unknown'
             })
         
         users_df = pd.DataFrame(users_data)
@@ -0,0 +1,103 @@
+# Local RFID reader simulator for the app's reader ingestion endpoint.
+# Start the app with RFID_INGEST_PORT set, then run for example:
+#   python reader_simulator.py --port 8765 --product P001 --branches main store1 --tags 1000 --rate 2000
+# The simulator first registers --tags new tags of --product in the first branch,
+# then sends portal reads that move random tags between the branches, with a
+# share of them sold, at --rate events per second for --duration seconds.
+# Like a real reader, each portal read can be reported --repeats times in a
+# row; the app drops the repeats in its deduplication window.
+# Events refused while the app's queue is full are sent again after a pause.
+import argparse
+import json
+import random
+import time
+import urllib.error
+import urllib.request
+
+
+def post_events(url, events):
+    request = urllib.request.Request(url, data=json.dumps(events).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'}, method='POST')
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        if e.code == 503:
+            return json.loads(e.read())
+        raise
+
+
+# Send events in batches at the given rate; returns the number of refused sends
+def send(url, events, rate, batch_size):
+    refused = 0
+    started = time.monotonic()
+    sent = 0
+    while sent < len(events):
+        batch = events[sent:sent + batch_size]
+        result = post_events(url, batch)
+        sent += result['accepted']
+        if result['rejected']:
+            # The queue is full; back off before sending the rest again
+            refused += result['rejected']
+            time.sleep(0.05)
+            continue
+        # Keep to the target rate
+        delay = started + sent / rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    return refused
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate RFID portal readers")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--product', required=True, help="Product ID of the simulated tags")
+    parser.add_argument('--branches', nargs='+', default=['main'], help="Branch IDs; tags start in the first one")
+    parser.add_argument('--tags', type=int, default=1000, help="Number of tags to register")
+    parser.add_argument('--prefix', default='SIM', help="Prefix of the simulated RFIDs")
+    parser.add_argument('--rate', type=float, default=1000, help="Events per second")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds of portal reads")
+    parser.add_argument('--sale-share', type=float, default=0.1, help="Share of portal reads that are sales")
+    parser.add_argument('--repeats', type=int, default=1, help="Times each portal read is reported")
+    parser.add_argument('--batch', type=int, default=100, help="Events per request")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    base_url = f"http://{args.host}:{args.port}"
+    rng = random.Random(args.seed)
+
+    rfids = [f"{args.prefix}{i:08d}" for i in range(args.tags)]
+    adds = [{'event': 'add', 'rfid': rfid, 'product_id': args.product, 'branch_id': args.branches[0]} for rfid in rfids]
+
+    started = time.monotonic()
+    refused = send(f"{base_url}/events", adds, args.rate, args.batch)
+    print(f"Registered {len(adds)} tags in {time.monotonic() - started:.1f}s ({refused} refused sends)")
+
+    # Portal reads: a tag seen at another branch's portal, or at the till
+    in_stock = list(rfids)
+    reads = []
+    for _ in range(int(args.rate * args.duration / args.repeats)):
+        if not in_stock:
+            break
+        index = rng.randrange(len(in_stock))
+        if rng.random() < args.sale_share:
+            rfid = in_stock.pop(index)
+            read = {'event': 'sale', 'rfid': rfid, 'sale_price': round(rng.uniform(1, 100), 2)}
+        else:
+            read = {'event': 'transfer', 'rfid': in_stock[index], 'branch_id': rng.choice(args.branches)}
+        reads.extend(dict(read) for _ in range(args.repeats))
+
+    started = time.monotonic()
+    refused = send(f"{base_url}/events", reads, args.rate, args.batch)
+    elapsed = time.monotonic() - started
+    print(f"Sent {len(reads)} reads in {elapsed:.1f}s ({len(reads) / max(elapsed, 1e-9):.0f}/s, {refused} refused sends)")
+
+    # Let the writer drain the queue, then show the app's counters
+    time.sleep(1)
+    with urllib.request.urlopen(f"{base_url}/metrics") as response:
+        print(json.dumps(json.loads(response.read()), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+import importlib
+import os
+import sys
+
+import pytest
+import streamlit as st
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Import app.py as a freshly started server working in an empty directory.
+# Calling the returned function again starts the app anew on the same data
+# directory, like a restart after a crash.
+@pytest.fixture
+def load_app(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('RFID_INGEST_PORT', '0')
+
+    def load(backend='json', archive_after_days=0):
+        monkeypatch.setenv('RFID_STORAGE_BACKEND', backend)
+        monkeypatch.setenv('RFID_ARCHIVE_AFTER_DAYS', str(archive_after_days))
+        # The shared store is cached per process; a restart starts without it
+        st.cache_resource.clear()
+        sys.modules.pop('app', None)
+        return importlib.import_module('app')
+
+    yield load
+    st.cache_resource.clear()
+    sys.modules.pop('app', None)
@@ -0,0 +1,30 @@
+import io
+
+from PIL import Image
+
+def png_bytes():
+    data = io.BytesIO()
+    Image.new('RGB', (400, 300), 'red').save(data, format='PNG')
+    return data.getvalue()
+
+def finished_job(status):
+    return {'status': status, 'error': None, 'submitted_at': '', 'finished_at': '2026-05-01 12:00:00'}
+
+def test_image_jobs_keep_finished_jobs_up_to_the_history_limit(load_app, monkeypatch):
+    app = load_app()
+    monkeypatch.setattr(app, 'IMAGE_JOB_HISTORY', 5)
+    with app.data_batch():
+        app.put_record('products', 'P1', {'name': 'Shirt', 'description': '', 'category': 'Shirts'})
+    for i in range(3):
+        app.store.image_jobs[f"old{i}"] = finished_job('failed')
+
+    app.queue_product_image('P1', png_bytes()).get('future').result()
+    # Under the limit nothing is dropped, so failed jobs stay visible
+    assert list(app.store.image_jobs) == ['old0', 'old1', 'old2', 'P1']
+    assert app.pending_image_job('old0')['status'] == 'failed'
+
+    for i in range(3, 6):
+        app.store.image_jobs[f"old{i}"] = finished_job('done')
+    app.queue_product_image('P1', png_bytes()).get('future').result()
+    assert list(app.store.image_jobs) == ['old2', 'old3', 'old4', 'old5', 'P1']
+    assert app.store.products['P1']['thumbnail']
@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+
+import pytest
+
+@pytest.fixture
+def clock(load_app, monkeypatch):
+    app = load_app()
+    now = [1000.0]
+    monkeypatch.setattr(app, 'time', SimpleNamespace(monotonic=lambda: now[0]))
+    return app, now
+
+def read(rfid, branch_id='main', **fields):
+    return {'event': 'add', 'rfid': rfid, 'branch_id': branch_id, **fields}
+
+def test_repeated_reads_are_dropped_within_a_sliding_window(clock):
+    app, now = clock
+    dedup = app.ReadDeduplicator(window_ms=2000, capacity=100)
+
+    assert not dedup.is_repeat(read('T1'))
+    now[0] += 1.5
+    assert dedup.is_repeat(read('T1'))
+    # Each repeat restarts the window
+    now[0] += 1.5
+    assert dedup.is_repeat(read('T1'))
+    now[0] += 2.0
+    assert not dedup.is_repeat(read('T1'))
+    assert dedup.suppressed == 2
+
+def test_reads_are_keyed_by_event_tag_and_reader(clock):
+    app, now = clock
+    dedup = app.ReadDeduplicator(window_ms=2000, capacity=100)
+
+    assert not dedup.is_repeat(read('T1'))
+    assert not dedup.is_repeat(read('T1', 'store1'))
+    assert not dedup.is_repeat({**read('T1'), 'event': 'sale'})
+    assert not dedup.is_repeat(read('T1', reader_id='dock'))
+    assert dedup.is_repeat(read('T1', 'store1', reader_id='dock'))
+    assert not dedup.is_repeat(read('T2'))
+
+    dedup.forget(read('T2'))
+    assert not dedup.is_repeat(read('T2'))
+
+def test_expired_reads_are_dropped_and_capacity_evicts_oldest(clock):
+    app, now = clock
+    dedup = app.ReadDeduplicator(window_ms=2000, capacity=3)
+
+    for i in range(3):
+        assert not dedup.is_repeat(read(f"T{i}"))
+        now[0] += 0.5
+    assert not dedup.is_repeat(read('T3'))
+    assert list(dedup.last_seen) == [('add', f"T{i}", 'main') for i in (1, 2, 3)]
+    assert dedup.evicted == 1
+    # T0 was evicted, so its read passes again
+    assert not dedup.is_repeat(read('T0'))
+
+    now[0] += 1.8
+    assert not dedup.is_repeat(read('T9'))
+    # Reads older than the window are expired before the capacity is checked
+    assert list(dedup.last_seen) == [('add', 'T3', 'main'), ('add', 'T0', 'main'), ('add', 'T9', 'main')]
+    assert dedup.evicted == 2
+
+def test_window_zero_disables_deduplication(clock):
+    app, now = clock
+    dedup = app.ReadDeduplicator(window_ms=0)
+    assert not dedup.is_repeat(read('T1'))
+    assert not dedup.is_repeat(read('T1'))
+    assert dedup.suppressed == 0
@@ -0,0 +1,146 @@
+import random
+
+import numpy as np
+
+BRANCHES = ['main', 'store1', 'store2']
+PRODUCTS = ['P1', 'P2', 'P3']
+
+def random_tag(rng, added_at):
+    product_id = rng.choice(PRODUCTS)
+    return {'product_id': product_id, 'category': f"Cat{product_id}", 'branch_id': rng.choice(BRANCHES),
+            'added_at': added_at}
+
+def add_products(app):
+    with app.data_batch():
+        for product_id in PRODUCTS:
+            app.put_record('products', product_id, {'name': f"Item {product_id}", 'description': '',
+                                                    'category': f"Cat{product_id}"})
+
+# Tags with random adds, moves and removals, enough to grow the columns and to
+# move many removed rows. Returns the random generator for further changes.
+def churn(app, count=3000, seed=1):
+    rng = random.Random(seed)
+    added_at = 1_700_000_000
+    with app.data_batch():
+        app.put_records('rfid_data', {f"T{i:05d}": random_tag(rng, added_at + i) for i in range(count)})
+    for step in range(4):
+        rfids = list(app.store.rfid_data)
+        with app.data_batch():
+            app.delete_records('rfid_data', rng.sample(rfids, count // 5))
+            for rfid in rng.sample(list(app.store.rfid_data), count // 10):
+                app.put_record('rfid_data', rfid, {**app.store.rfid_data[rfid], 'branch_id': rng.choice(BRANCHES)})
+            added_at += count
+            app.put_records('rfid_data', {f"S{step}-{i}": random_tag(rng, added_at + i) for i in range(count // 4)})
+    return rng
+
+def view_rows(frame):
+    return sorted(zip(frame['RFID'], frame['Product ID'].astype(object), frame['Category'].astype(object),
+                      frame['Branch ID'].astype(object), frame['Added At'].to_numpy().astype(np.int64)))
+
+def inventory_rows(app, branch_id=None):
+    return sorted((rfid, item['product_id'], item['category'], item['branch_id'], item['added_at'])
+                  for rfid, item in app.store.rfid_data.items()
+                  if branch_id is None or item['branch_id'] == branch_id)
+
+def test_inventory_view_matches_rfid_data_after_changes(load_app):
+    app = load_app()
+    add_products(app)
+    churn(app)
+
+    view = app.store.inventory
+    assert view.size == len(app.store.rfid_data)
+    assert all(view.rfids[view.positions[rfid]] == rfid for rfid in app.store.rfid_data)
+    assert view_rows(view.frame()) == inventory_rows(app)
+    for branch_id in BRANCHES:
+        assert view_rows(view.frame(branch_id)) == inventory_rows(app, branch_id)
+    frame = view.frame('main')
+    assert set(frame['Product Name']) <= {f"Item {product_id}" for product_id in PRODUCTS}
+    assert set(frame['Branch Name']) == {"Main Branch"}
+
+def test_inventory_view_select_returns_oldest_first(load_app):
+    app = load_app()
+    add_products(app)
+    churn(app)
+
+    for branch_id in BRANCHES:
+        expected = sorted((item['added_at'], rfid) for rfid, item in app.store.rfid_data.items()
+                          if item['branch_id'] == branch_id and item['product_id'] in ('P1', 'P2'))
+        selected = app.store.inventory.select(branch_id, product_ids=['P1', 'P2', 'P9'])
+        assert selected.tolist() == [rfid for _, rfid in expected]
+        selected = app.store.inventory.select(branch_id, categories=['CatP3'])
+        assert len(selected) == sum(1 for item in app.store.rfid_data.values()
+                                    if item['branch_id'] == branch_id and item['category'] == 'CatP3')
+    assert app.store.inventory.select('nowhere').tolist() == []
+
+def test_inventory_view_follows_rolled_back_batches(load_app):
+    app = load_app()
+    add_products(app)
+    churn(app, count=500)
+    expected = inventory_rows(app)
+
+    try:
+        with app.data_batch():
+            app.delete_records('rfid_data', list(app.store.rfid_data)[:100])
+            app.put_record('rfid_data', 'NEW', {'product_id': 'P1', 'category': 'CatP1', 'branch_id': 'main',
+                                                'added_at': 1})
+            raise RuntimeError("abort")
+    except RuntimeError:
+        pass
+
+    assert view_rows(app.store.inventory.frame()) == expected
+
+def expected_matches(app, search):
+    search = search.strip().lower()
+    return sorted(rfid for rfid, item in app.store.rfid_data.items()
+                  if rfid.lower().startswith(search)
+                  or search in app.product_search_text(item['product_id'], app.store.products[item['product_id']]).lower())
+
+SEARCHES = ['T0', 't01', 'S2-', 'abc', 'ABC1 ', 'item p2', 'p3', 'x', 'zzz']
+
+def test_inventory_search_matches_rfid_prefixes_and_products(load_app):
+    app = load_app()
+    add_products(app)
+    rng = churn(app)
+    with app.data_batch():
+        app.put_records('rfid_data', {rfid: random_tag(rng, 1) for rfid in ('AbC1', 'abc1', 'ABC2', 'xyz')})
+    for search in SEARCHES:
+        assert sorted(app.store.inventory.frame(search=search)['RFID']) == expected_matches(app, search), search
+
+    # After a restart the tags are in the sorted arrays; remove and add enough
+    # of them to compact the arrays and merge the new tags in
+    app = load_app()
+    with app.data_batch():
+        app.delete_records('rfid_data', ['abc1', 'xyz'])
+    churn(app, seed=2)
+    view = app.store.inventory
+    for search in SEARCHES:
+        assert sorted(view.frame(search=search)['RFID']) == expected_matches(app, search), search
+        for branch_id in BRANCHES:
+            assert sorted(view.frame(branch_id, search)['RFID']) == [
+                rfid for rfid in expected_matches(app, search) if app.store.rfid_data[rfid]['branch_id'] == branch_id]
+    assert view.removed_count == 0 and not view.pending_rfids
+    assert len(view.sorted_keys) == len(app.store.rfid_data)
+
+def test_ngram_index_search(load_app):
+    app = load_app()
+    index = app.NgramIndex()
+    index.update('P2', app.product_search_text('P2', {'name': 'Blue Shirt'}))
+    index.update('P1', app.product_search_text('P1', {'name': 'Red shirt'}))
+    index.update('P10', app.product_search_text('P10', {'name': 'Scarf'}))
+
+    # Results keep the order the keys were first added
+    assert index.search('SHIRT') == ['P2', 'P1']
+    assert index.search('p1') == ['P1', 'P10']
+    assert index.search(' red ') == ['P1']
+    assert index.search('sc') == ['P10']
+    # A match never spans the ID and the name
+    assert index.search('p1r') == []
+
+    index.update('P2', app.product_search_text('P2', {'name': 'Blue Scarf'}))
+    assert index.search('shirt') == ['P1']
+    assert index.search('scarf') == ['P2', 'P10']
+    index.update('P10', None)
+    assert index.search('scarf') == ['P2']
+    assert index.search('p10') == []
+    assert all(keys for keys in index.postings.values())
+    assert 'P10' not in set().union(*index.postings.values())
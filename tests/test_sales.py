@@ -0,0 +1,55 @@
+import time
+from types import SimpleNamespace
+from datetime import date, datetime
+
+import pandas as pd
+import pytest
+
+# Run the test in a time zone away from UTC, where Unix times and stored
+# epoch seconds differ
+@pytest.fixture
+def new_york(monkeypatch):
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+def stock(app, rfids):
+    with app.data_batch():
+        app.put_record('products', 'P1', {'name': 'Shirt', 'description': '', 'category': 'Shirts'})
+        app.put_records('rfid_data', {rfid: {'product_id': 'P1', 'category': 'Shirts', 'branch_id': 'main',
+                                             'added_at': app.now_epoch()} for rfid in rfids})
+
+def test_sale_basket_keeps_local_sale_time(load_app, new_york, monkeypatch):
+    app = load_app()
+    stock(app, ['T1', 'T2'])
+    # Session state only works under `streamlit run`
+    session = SimpleNamespace(sale_basket={rfid: {'RFID': rfid, 'Sale Price': 9.5} for rfid in ('T1', 'T2')},
+                              basket_sale_date=date(2026, 5, 1), basket_sale_time=datetime(2026, 5, 1, 12, 0).time())
+    monkeypatch.setattr(app.st, 'session_state', session)
+
+    app.sell_sale_basket()
+
+    expected = app.to_epoch('2026-05-01 12:00:00')
+    assert [sale['sale_date'] for sale in app.store.sales] == [expected, expected]
+    assert [transaction['timestamp'] for transaction in app.store.transactions] == [expected, expected]
+    assert session.sale_basket == {}
+    assert session.sale_basket_message == ('success', "Sold 2 items")
+
+def test_sales_file_dates_are_parsed_as_local_time_or_unix_time(load_app, new_york):
+    app = load_app()
+    stock(app, ['T1', 'T2', 'T3'])
+    # 2026-05-01 12:00:00 UTC is 08:00:00 in New York
+    df = pd.DataFrame({'rfid': ['T1', 'T2', 'T3'],
+                       'sale_date': ['2026-05-01 12:00:00', 1777636800, 'not a date'],
+                       'sale_price': [1, 'x', 3]})
+
+    before = app.now_epoch()
+    results = app.process_sales_excel(df)
+
+    assert results['status'].tolist() == ['sold', 'sold', 'sold']
+    dates = [sale['sale_date'] for sale in app.store.sales]
+    assert dates[:2] == [app.to_epoch('2026-05-01 12:00:00'), app.to_epoch('2026-05-01 08:00:00')]
+    assert dates[2] >= before
+    assert [sale['sale_price'] for sale in app.store.sales] == [1, None, 3]
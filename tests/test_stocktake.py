@@ -0,0 +1,52 @@
+import pandas as pd
+
+def stock(app, rfids, branch_id):
+    app.put_records('rfid_data', {rfid: {'product_id': 'P1', 'category': 'Shirts', 'branch_id': branch_id,
+                                         'added_at': app.now_epoch()} for rfid in rfids})
+
+def setup_branches(app):
+    with app.data_batch():
+        app.put_record('branches', 'store1', {'name': 'Store 1', 'address': '', 'created_at': app.now_epoch()})
+        app.put_record('products', 'P1', {'name': 'Shirt', 'description': '', 'category': 'Shirts'})
+        stock(app, ['A1', 'A2', 'A3', 'A4'], 'main')
+        stock(app, ['B1', 'B2'], 'store1')
+
+def test_scanned_rfids_are_deduplicated_across_chunks(load_app):
+    app = load_app()
+    seen = set()
+    first = app.read_scanned_rfids(pd.DataFrame({'rfid': [' A1', 'A2', None, '', 'A1']}), seen)
+    second = app.read_scanned_rfids(pd.DataFrame({'rfid': ['A2', 'A3', 'A3']}, index=[5, 6, 7]), seen)
+    assert first.tolist() == ['A1', 'A2']
+    assert second.tolist() == ['A3']
+    assert seen == {'A1', 'A2', 'A3'}
+
+def test_reconcile_stocktake_classifies_discrepancies(load_app):
+    app = load_app()
+    setup_branches(app)
+
+    found, discrepancies = app.reconcile_stocktake('main', ['A1', 'A2', 'B1', 'X1'])
+
+    assert found == 2
+    assert discrepancies[['rfid', 'status', 'booked_branch_id']].values.tolist() == [
+        ['A3', 'missing', 'main'], ['A4', 'missing', 'main'],
+        ['B1', 'unexpected', 'store1'],
+        ['X1', 'unknown', None]]
+    assert discrepancies['product_name'][:3].tolist() == ['Shirt', 'Shirt', 'Shirt']
+    assert pd.isna(discrepancies['product_name'][3])
+
+def test_apply_stocktake_books_transfers_and_missing_tags(load_app):
+    app = load_app()
+    setup_branches(app)
+    _, discrepancies = app.reconcile_stocktake('main', ['A1', 'A2', 'B1', 'X1'])
+    # Sold after the scan was reconciled, so no longer missing from the branch
+    assert app.process_sale('A4')[0]
+
+    success, message = app.apply_stocktake('main', discrepancies, timestamp=100)
+
+    assert success, message
+    assert sorted(app.store.rfid_data) == ['A1', 'A2', 'B1', 'B2']
+    assert app.store.rfid_data['B1']['branch_id'] == 'main'
+    assert sorted(app.indexed_keys('rfid_data', 'branch_id', 'main')) == ['A1', 'A2', 'B1']
+    assert [(t['rfid'], t['action']) for t in app.store.transactions if t['timestamp'] == 100] == [
+        ('B1', 'transferred'), ('A3', 'missing')]
+    assert app.reconcile_stocktake('main', ['A1', 'A2', 'B1'])[1].empty
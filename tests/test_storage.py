@@ -0,0 +1,229 @@
+import copy
+import json
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+BACKENDS = ['json', 'sqlite']
+HISTORY = ['sales', 'transactions', 'transfers']
+
+def tag(app, i, branch_id='main', product_id='P1'):
+    return {'product_id': product_id, 'category': 'Shirts', 'branch_id': branch_id, 'added_at': app.now_epoch() + i}
+
+def sale(i, sale_date):
+    return {'rfid': f"T{i}", 'product_id': 'P1', 'product_name': 'Shirt', 'category': 'Shirts',
+            'branch_id': 'main', 'sale_date': sale_date, 'sale_price': 10.0 + i}
+
+def transaction(i, timestamp):
+    return {'rfid': f"T{i}", 'product_id': 'P1', 'branch_id': 'main', 'action': 'added', 'timestamp': timestamp}
+
+def transfer(i, timestamp):
+    return {'rfid': f"T{i}", 'product_id': 'P1', 'product_name': 'Shirt',
+            'from_branch_id': 'main', 'to_branch_id': 'store1', 'timestamp': timestamp}
+
+# Record a mix of single and bulk journal operations, each in its own batch
+def record_mutations(app):
+    now = app.now_epoch()
+    with app.data_batch():
+        app.put_record('products', 'P1', {'name': 'Shirt', 'description': '', 'category': 'Shirts'})
+        app.append_record('categories', 'Shirts')
+    with app.data_batch():
+        app.put_records('rfid_data', {f"T{i}": tag(app, i) for i in range(6)})
+    for i in range(3):
+        with app.data_batch():
+            app.append_record('sales', sale(i, now + i))
+            app.append_record('transactions', transaction(i, now + i))
+    with app.data_batch():
+        app.extend_records('sales', [sale(i, now + i) for i in range(3, 6)])
+        app.extend_records('transfers', [transfer(i, now + i) for i in range(3)])
+    with app.data_batch():
+        app.delete_records('rfid_data', ['T0', 'T1'])
+        app.put_record('rfid_data', 'T2', tag(app, 2, branch_id='store1'))
+        app.delete_record('rfid_data', 'T3')
+
+def saved_collections(app):
+    return copy.deepcopy({collection: app.store.data[collection]
+                          for collection in ('rfid_data', 'products', 'categories', *HISTORY)})
+
+def derived_state(app):
+    return copy.deepcopy((app.store.indexes, app.store.rollups, app.store.product_search.texts))
+
+# Compaction writes the snapshots one by one and empties the journal last. A
+# crash in between leaves snapshots that already contain some of the journal
+# records, which are replayed again on the next start.
+@pytest.mark.parametrize('snapshots_written', [[], ['sales'], ['rfid_data', 'sales', 'transfers'], 'all'])
+def test_journal_replay_after_interrupted_compaction(load_app, snapshots_written):
+    app = load_app()
+    record_mutations(app)
+    expected = saved_collections(app)
+
+    if snapshots_written == 'all':
+        snapshots_written = list(app.store.dirty_collections)
+    for collection in snapshots_written:
+        app.store.storage.write_snapshot(collection, app.store.data[collection])
+    # A record torn by the crash
+    with open(app.JOURNAL_PATH, 'a', encoding='utf-8') as f:
+        f.write('{"c": "sales", "op": "app')
+
+    app = load_app()
+    assert saved_collections(app) == expected
+    assert app.rollup_frame('sales')['count'].sum() == 6
+    assert sorted(app.indexed_keys('rfid_data', 'branch_id', 'main')) == ['T4', 'T5']
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_journal_records_can_be_replayed_twice(load_app, backend, monkeypatch):
+    app = load_app(backend)
+    written = []
+    write = app.store.storage.write
+    monkeypatch.setattr(app.store.storage, 'write', lambda entries: (written.extend(copy.deepcopy(entries)), write(entries)))
+    record_mutations(app)
+    expected = saved_collections(app)
+
+    write(written)
+
+    app = load_app(backend)
+    assert saved_collections(app) == expected
+
+def test_migrate_json_to_sqlite(load_app):
+    app = load_app('json')
+    record_mutations(app)
+    # Part of the data in the snapshots, the rest only in the journal
+    app.compact_data()
+    with app.data_batch():
+        app.put_record('rfid_data', 'T6', tag(app, 6))
+        app.append_record('sales', sale(6, app.now_epoch()))
+    expected = saved_collections(app)
+
+    app = load_app('sqlite')
+    assert saved_collections(app) == expected
+
+    # The migration only runs for a new database
+    app = load_app('sqlite')
+    assert saved_collections(app) == expected
+
+# Data files of earlier versions store timestamps as text in local time
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_text_timestamps_of_json_files_are_converted(load_app, backend, tmp_path):
+    files = {
+        'rfid_data': {'T1': {'product_id': 'P1', 'category': 'Shirts', 'branch_id': 'main', 'added_at': '2024-03-05 10:20:30'}},
+        'sales': [sale(0, '2024-03-04 09:00:00')],
+        'transfers': [transfer(1, '2024-03-06 23:59:59')],
+        'branches': {'main': {'name': 'Main Branch', 'address': '', 'created_at': '2024-01-01 08:00:00'}}
+    }
+    (tmp_path / 'data').mkdir()
+    for collection, value in files.items():
+        (tmp_path / 'data' / f"{collection}.json").write_text(json.dumps(value), encoding='utf-8')
+    with open(tmp_path / 'data' / 'journal.jsonl', 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'c': 'transactions', 'op': 'append', 'i': 0, 'v': transaction(1, '2024-03-05 10:20:30')}) + '\n')
+
+    app = load_app(backend)
+    assert app.store.rfid_data['T1']['added_at'] == app.to_epoch('2024-03-05 10:20:30')
+    assert app.store.sales[0]['sale_date'] == app.to_epoch('2024-03-04 09:00:00')
+    assert app.store.transactions[0]['timestamp'] == app.to_epoch('2024-03-05 10:20:30')
+    assert app.store.transfers[0]['timestamp'] == app.to_epoch('2024-03-06 23:59:59')
+    assert app.store.branches['main']['created_at'] == app.to_epoch('2024-01-01 08:00:00')
+    assert app.rollup_frame('sales')['date'].tolist() == [pd.Timestamp('2024-03-04')]
+
+    # The converted data was saved, so it is loaded as integers from now on
+    app = load_app(backend)
+    assert app.store.sales[0]['sale_date'] == app.to_epoch('2024-03-04 09:00:00')
+    assert app.store.transactions[0]['timestamp'] == app.to_epoch('2024-03-05 10:20:30')
+
+# A crash after an archive run was committed to the manifest but before the hot
+# collections were trimmed is finished by the next start; applying the same
+# pending trims again must not drop any further records.
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_apply_pending_archives_is_idempotent(load_app, backend, monkeypatch):
+    app = load_app(backend)
+    old = app.to_epoch(datetime.now() - timedelta(days=400))
+    recent = app.now_epoch()
+    records = [sale(i, old + i) for i in range(5)] + [sale(i, recent + i) for i in range(5, 8)]
+    with app.data_batch():
+        app.extend_records('sales', records)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(app, 'ARCHIVE_AFTER_DAYS', 365)
+        patch.setattr(app, 'apply_pending_archives', lambda manifest: None)
+        app.archive_history()
+    manifest = app.load_archive_manifest()
+    assert manifest['pending']
+    assert app.store.sales == records
+
+    app = load_app(backend)
+    assert app.store.sales == records[5:]
+    assert app.load_archive_manifest()['pending'] == {}
+
+    with app.store.lock:
+        app.apply_pending_archives(copy.deepcopy(manifest))
+    assert app.store.sales == records[5:]
+
+    app = load_app(backend)
+    assert app.store.sales == records[5:]
+    history = app.query_history('sales')
+    assert history['rfid'].tolist() == [record['rfid'] for record in records]
+    assert app.rollup_frame('sales')['count'].sum() == len(records)
+
+def test_data_batch_rolls_back_indexes_and_rollups(load_app):
+    app = load_app()
+    record_mutations(app)
+    collections = saved_collections(app)
+    state = derived_state(app)
+    inventory = app.store.inventory.frame()
+
+    with pytest.raises(RuntimeError):
+        with app.data_batch():
+            app.put_record('rfid_data', 'T9', tag(app, 9, branch_id='store1', product_id='P2'))
+            app.put_record('rfid_data', 'T4', tag(app, 4, branch_id='store1'))
+            app.delete_records('rfid_data', ['T5'])
+            app.put_record('products', 'P2', {'name': 'Scarf', 'description': '', 'category': 'Accessories'})
+            app.delete_record('products', 'P1')
+            app.append_record('sales', sale(9, app.now_epoch()))
+            app.extend_records('transfers', [transfer(9, app.now_epoch())])
+            raise RuntimeError("abort")
+
+    assert saved_collections(app) == collections
+    assert derived_state(app) == state
+    pd.testing.assert_frame_equal(app.store.inventory.frame(), inventory)
+    assert app.store.pending_journal == []
+    assert app.store.batch_depth == 0
+
+def test_data_batch_rolls_back_failed_save(load_app, monkeypatch):
+    app = load_app()
+    record_mutations(app)
+    collections = saved_collections(app)
+    state = derived_state(app)
+
+    def fail(entries):
+        raise OSError("disk full")
+    monkeypatch.setattr(app.store.storage, 'write', fail)
+    with pytest.raises(app.SaveError):
+        with app.data_batch():
+            app.put_record('rfid_data', 'T9', tag(app, 9, branch_id='store1'))
+            app.append_record('sales', sale(9, app.now_epoch()))
+
+    assert saved_collections(app) == collections
+    assert derived_state(app) == state
+    assert app.store.pending_journal == []
+
+def test_nested_data_batch_only_rolls_back_inner_block(load_app):
+    app = load_app()
+    record_mutations(app)
+    rollups = copy.deepcopy(app.store.rollups)
+    sales = copy.deepcopy(app.store.sales)
+
+    with app.data_batch():
+        app.put_record('rfid_data', 'T9', tag(app, 9, branch_id='store1'))
+        with pytest.raises(RuntimeError):
+            with app.data_batch():
+                app.append_record('sales', sale(9, app.now_epoch()))
+                app.delete_record('rfid_data', 'T9')
+                raise RuntimeError("abort")
+
+    assert sorted(app.indexed_keys('rfid_data', 'branch_id', 'store1')) == ['T2', 'T9']
+    assert app.store.sales == sales
+    assert app.store.rollups == rollups
+
+    app = load_app()
+    assert 'T9' in app.store.rfid_data
+    assert app.store.sales == sales
@@ -0,0 +1,51 @@
+import io
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pandas as pd
+
+class UploadedFile(io.BytesIO):
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+        self.size = len(data)
+
+def test_upload_is_read_once_and_classified_again_after_inventory_changes(load_app, monkeypatch):
+    app = load_app()
+    # Session state only works under `streamlit run`
+    monkeypatch.setattr(app.st, 'session_state', SimpleNamespace(upload_cache=OrderedDict(), upload_classification=None))
+    reads = []
+    process_upload = app.process_upload
+    monkeypatch.setattr(app, 'process_upload', lambda file, process: reads.append(file.name) or process_upload(file, process))
+    data = b'rfid\nT1\nT2\n'
+
+    first = app.classify_upload(UploadedFile(data, 'a.csv'))
+    assert first['status'].tolist() == ['new', 'new']
+    assert app.classify_upload(UploadedFile(data, 'b.csv')) is first
+
+    with app.data_batch():
+        app.put_record('products', 'P1', {'name': 'Shirt', 'description': '', 'category': 'Shirts'})
+        app.put_record('rfid_data', 'T1', {'product_id': 'P1', 'category': 'Shirts', 'branch_id': 'main',
+                                           'added_at': app.now_epoch()})
+    results = app.classify_upload(UploadedFile(data, 'a.csv'))
+    assert results['status'].tolist() == ['existing', 'new']
+    assert reads == ['a.csv']
+
+def test_process_excel_flags_duplicates_within_and_across_chunks(load_app):
+    app = load_app()
+    with app.data_batch():
+        app.put_record('products', 'P1', {'name': 'Shirt', 'description': '', 'category': 'Shirts'})
+        app.put_record('rfid_data', 'OLD', {'product_id': 'P1', 'category': 'Shirts', 'branch_id': 'main',
+                                            'added_at': app.now_epoch()})
+    seen = set()
+    first = app.process_excel(pd.DataFrame({'rfid': ['N1', ' N1 ', 'OLD', 'OLD', None, '  ', 'N2']}), seen)
+    second = app.process_excel(pd.DataFrame({'rfid': ['N2', 'OLD', 'N3']}, index=[7, 8, 9]), seen)
+
+    assert first['status'].tolist() == ['new', 'duplicate', 'existing', 'duplicate', 'error', 'error', 'new']
+    assert first['rfid'].tolist()[:4] == ['N1', 'N1', 'OLD', 'OLD']
+    assert first.loc[2, 'message'] == "Tag already exists for product Shirt (ID: P1)"
+    assert first.loc[1, 'message'] == "RFID tag appears more than once in the file"
+    assert first.loc[4, 'message'] == "Missing RFID tag in row"
+    assert second['status'].tolist() == ['duplicate', 'duplicate', 'new']
+    assert second.index.tolist() == [7, 8, 9]
+    assert seen == {'N1', 'OLD', 'N2', 'N3'}